@@ -3,14 +3,36 @@
 # required libraries
 
 import argparse
+import array
+import bisect
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
 import enum
 import filecmp
+import functools
+import hashlib
+import heapq
+import itertools
 import json
+import mmap
 import os
+import platform
+import shutil
 import stat
+import struct
+import sys
+import threading
 import time
 import urllib
 import urllib3
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 ##############################################################################
 # internally used Exception types                                            #
@@ -48,21 +70,300 @@ class LogLevel(enum.IntEnum):
     INFO = 2
     DEBUG = 3
 
-def Log(message, level=LogLevel.INFO):
-    if (level <= Config.settings['logLevel']):
+# Messages may be given as a %-format template with arguments: the message
+# is then only formatted when it is actually logged, and repetitions of the
+# same warning template beyond logRepeatLimit are only counted, see
+# LogSummary(). Errors are always printed, and with logLevel DEBUG, everything
+# is printed.
+
+logCounts = {}
+logLock = threading.Lock()
+
+def isLogged(level):
+    return level <= Config.settings['logLevel']
+
+def Log(message, level=LogLevel.INFO, *args):
+    if (level > Config.settings['logLevel']):
+        return
+    template = None
+    if len(args) > 0:
+        template = message
+        limit = Config.settings['logRepeatLimit']
+        if limit > 0 and level == LogLevel.WARN and Config.settings['logLevel'] < LogLevel.DEBUG:
+            with logLock:
+                cnt, lvl = logCounts.get(template, (0, level))
+                logCounts[template] = (cnt + 1, level)
+            if cnt >= limit:
+                return
+        message = message % args
+    if Config.settings['logFormat'] == 'json':
+        record = {'time': time.time(), 'level': LogLevel(level).name, 'message': message}
+        if template != None:
+            record['template'] = template
+            record['args'] = [str(a) for a in args]
+        print(json.dumps(record))
+    else:
         print(str(level) + ': ' + message)
 
-def Error(message):
-    Log(message, LogLevel.ERROR)
+def LogSummary():
+    limit = Config.settings['logRepeatLimit']
+    with logLock:
+        repeated = [(template, cnt, level) for template, (cnt, level) in logCounts.items() if cnt > limit]
+        logCounts.clear()
+    for template, cnt, level in repeated:
+        Log(str(cnt - limit) + ' more messages like: ' + template.replace('%s', '...').replace('%d', '...'), level)
+
+class LazyMapName:
+    # formats the map name only when the log message is actually printed
+    def __init__(self, m):
+        self.m = m
+
+    def __str__(self):
+        return mapName(self.m)
+
+def Error(message, *args):
+    Log(message, LogLevel.ERROR, *args)
+
+def Warn(message, *args):
+    Log(message, LogLevel.WARN, *args)
+
+def Info(message, *args):
+    Log(message, LogLevel.INFO, *args)
+
+def Debug(message, *args):
+    Log(message, LogLevel.DEBUG, *args)
+
+##############################################################################
+# Profiling functions                                                        #
+##############################################################################
+
+class ProfilePhase:
+    def __init__(self, profiler, name, args = None):
+        self.profiler = profiler
+        self.name = name
+        self.args = args if args != None else {}
+
+    def __enter__(self):
+        self.profiler.getStack().append(self)
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        wall = time.perf_counter()
+        self.profiler.add(self.name, wall - self.wall, time.thread_time() - self.cpu)
+        self.profiler.getStack().pop()
+        if self.profiler.traceFile != None:
+            self.profiler.addTraceEvent(self.name, self.wall, wall, self.args)
+        return False
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.summary = False
+        self.traceFile = None
+        self.phases = {}
+        self.events = []
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, summary, traceFile):
+        self.summary = summary
+        self.traceFile = traceFile
+        self.enabled = summary or traceFile != None
+
+    def getStack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def annotate(self, key, value):
+        # attach an argument to the innermost phase of the current thread
+        if self.enabled:
+            stack = self.getStack()
+            if len(stack) > 0:
+                stack[-1].args[key] = value
+
+    def addTraceEvent(self, name, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+                 'ts': int(start * 1000000), 'dur': int((end - start) * 1000000)}
+        if len(args) > 0:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread.ident,
+                                    'args': {'name': thread.name}})
+
+    def writeTrace(self):
+        # Chrome trace event format, for chrome://tracing or Perfetto
+        try:
+            f = open(file = self.traceFile, mode = 'wt', encoding = 'utf-8')
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+            f.close()
+            Info('wrote trace of ' + str(len(self.events)) + ' events to "' + self.traceFile + '"')
+        except Exception as E:
+            Warn('trace could not be written to "' + self.traceFile + '": ' + str(E))
+
+    @staticmethod
+    def getPeakRSS():
+        # in bytes, or None if not available on this platform
+        if resource == None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    def phase(self, name, args = None):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return ProfilePhase(self, name, args)
+
+    def add(self, name, wall, cpu):
+        rss = self.getPeakRSS()
+        with self.lock:
+            cnt, w, c, r = self.phases.get(name, (0, 0.0, 0.0, None))
+            self.phases[name] = (cnt + 1, w + wall, c + cpu, rss)
+
+    def show(self):
+        print('%-24s %8s %10s %10s %12s' % ('phase', 'calls', 'wall [s]', 'cpu [s]', 'peak RSS'))
+        for name, (cnt, wall, cpu, rss) in self.phases.items():
+            rssDesc = '%9.1f MiB' % (rss / (1024 * 1024)) if rss != None else '         n/a'
+            print('%-24s %8d %10.3f %10.3f %12s' % (name, cnt, wall, cpu, rssDesc))
+
+def Profiled(name):
+    # decorator: account all calls of the function to the profiling phase name
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Profile.enabled:
+                return func(*args, **kwargs)
+            with Profile.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+##############################################################################
+# Metrics                                                                    #
+##############################################################################
+
+class MetricsCollector:
+    # collects the metrics of a run for the Prometheus textfile collector
+    durationBuckets = [0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
 
-def Warn(message):
-    Log(message, LogLevel.WARN)
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
 
-def Info(message):
-    Log(message, LogLevel.INFO)
+    @staticmethod
+    def formatLabels(labels):
+        if labels == None or len(labels) < 1:
+            return ''
+        parts = []
+        for name, value in sorted(labels.items()):
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(name + '="' + value + '"')
+        return '{' + ','.join(parts) + '}'
+
+    def set(self, name, value, labels = None, help = None):
+        with self.lock:
+            self.metrics[(name, self.formatLabels(labels))] = value
+            if help != None:
+                self.help[name] = help
+
+    def inc(self, name, value = 1, labels = None, help = None):
+        # the sums start at 0 in every run, so they are gauges as well
+        key = (name, self.formatLabels(labels))
+        with self.lock:
+            self.metrics[key] = self.metrics.get(key, 0) + value
+            if help != None:
+                self.help[name] = help
+
+    def observe(self, name, value, help = None):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = [[0] * len(self.durationBuckets), 0, 0.0]
+            h = self.histograms[name]
+            for i, bound in enumerate(self.durationBuckets):
+                if value <= bound:
+                    h[0][i] = h[0][i] + 1
+            h[1] = h[1] + 1
+            h[2] = h[2] + value
+            if help != None:
+                self.help[name] = help
 
-def Debug(message):
-    Log(message, LogLevel.DEBUG)
+    @staticmethod
+    def readFamilies(filename):
+        # returns the lines of an existing metrics file by metric family, the
+        # samples of a histogram belong to the family of the last TYPE line
+        families = {}
+        name = None
+        try:
+            f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                    name = line.split(' ')[2]
+                if name != None and len(line) > 0:
+                    families.setdefault(name, []).append(line)
+            f.close()
+        except FileNotFoundError:
+            pass
+        return families
+
+    def format(self, previous = None):
+        # the series of previous which are not set in this run are kept, so
+        # the operations which share the file don't drop each other's series
+        if previous == None:
+            previous = {}
+        lines = []
+        with self.lock:
+            names = []
+            for name, labels in self.metrics:
+                if name not in names:
+                    names.append(name)
+            for name in names:
+                if name in self.help:
+                    lines.append('# HELP ' + name + ' ' + self.help[name])
+                lines.append('# TYPE ' + name + ' gauge')
+                current = set()
+                for (n, labels), value in self.metrics.items():
+                    if n == name:
+                        lines.append(name + labels + ' ' + repr(value))
+                        current.add(name + labels)
+                for line in previous.get(name, []):
+                    if line[0] != '#' and line.rsplit(' ', 1)[0] not in current:
+                        lines.append(line)
+            for name, family in previous.items():
+                if name not in names and name not in self.histograms:
+                    lines.extend(family)
+            for name, (buckets, cnt, total) in self.histograms.items():
+                if name in self.help:
+                    lines.append('# HELP ' + name + ' ' + self.help[name])
+                lines.append('# TYPE ' + name + ' histogram')
+                for bound, bucketCnt in zip(self.durationBuckets, buckets):
+                    lines.append(name + '_bucket{le="' + repr(bound) + '"} ' + str(bucketCnt))
+                lines.append(name + '_bucket{le="+Inf"} ' + str(cnt))
+                lines.append(name + '_sum ' + repr(total))
+                lines.append(name + '_count ' + str(cnt))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        # node_exporter must never see a partial file, so write to a
+        # temporary file in the same directory and rename it atomically
+        try:
+            text = self.format(self.readFamilies(filename))
+            f = open(file = filename + '.tmp', mode = 'wt', encoding = 'utf-8')
+            f.write(text)
+            f.close()
+            os.replace(filename + '.tmp', filename)
+            Debug('wrote metrics file "' + filename + '"')
+        except Exception as E:
+            Warn('metrics file "' + filename + '" could not be written: ' + str(E))
 
 ##############################################################################
 # Level properties                                                           #
@@ -129,6 +430,13 @@ def equalFileNames(a, b):
     else:
         return (a == b)
 
+def fileNameKey(name):
+    # key for dictionaries of file names, matching the rules of equalFileNames
+    if Config.settings['filenameCaseSensitive']:
+        return name.casefold()
+    else:
+        return name
+
 def mapStatus(m):
     desc = '(' + (' ' if m['hidden'] > 0 else '*') + ')'
     return desc
@@ -137,15 +445,9 @@ def mapTypes(m, compact=False):
     return MapType.getCombinedDesc(m['types'], None if compact else '  ')
 
 def mapAndLevelName(m):
-    desc = '"' + m['filename'] + '": ['
-    cnt = 0
-    for n in m['names']:
-        if cnt > 0:
-            desc = desc + ', '
-        desc = desc + '"' + n + '"'
-        cnt = cnt + 1
-    desc = desc + ']'
-    return desc
+    if len(m['names']) < 1:
+        return '"' + m['filename'] + '": []'
+    return '"' + m['filename'] + '": ["' + '", "'.join(m['names']) + '"]'
 
 def mapName(m):
     #return '"' + m['id'] + '/' + m['filename'] + '"'
@@ -216,6 +518,116 @@ class MapManager:
         self.valid = False
         self.name = 'generic'
         self.timestamp = time.time();
+        self.prevalidated = False
+        self.fingerprint = None
+        self.listChanges = 0
+        self.timeIndex = None
+
+    sortKeys = {
+        'mtime': lambda m: m['mtime'],
+        'size': lambda m: m['size'],
+        'type': lambda m: m['types'],
+        'name': lambda m: m['filename'].casefold()
+    }
+
+    @classmethod
+    def sortMaps(cls, maps, order):
+        # order is a comma-separated list of keys, prefix a key with - or
+        # append :desc to sort descending
+        result = list(maps)
+        for name, reverse in reversed(cls.parseSortOrder(order)):
+            result.sort(key = cls.sortKeys[name], reverse = reverse)
+        return result
+
+    @classmethod
+    def parseSortOrder(cls, order):
+        keys = []
+        for k in order.split(','):
+            k = k.strip()
+            if len(k) < 1:
+                continue
+            reverse = False
+            if k[0] in '+-':
+                reverse = (k[0] == '-')
+                k = k[1:]
+            idx = k.find(':')
+            if idx >= 0:
+                reverse = (k[idx+1:].casefold() == 'desc')
+                k = k[0:idx]
+            if k not in cls.sortKeys:
+                raise OlmappyConfigError('unknown sort key "' + k + '", must be one of: ' + ', '.join(cls.sortKeys))
+            keys.append((k, reverse))
+        return keys
+
+    def getCacheFileName(self, name):
+        return Config.settings['mapPath'] + 'cache/' + name
+
+    def getSnapshot(self):
+        if not Config.settings['catalogueSnapshots']:
+            return None
+        return CatalogueSnapshot(self.getCacheFileName(self.name + '.snapshot'))
+
+    def loadSnapshot(self, fingerprint):
+        # replaces the map list by the validated snapshot for fingerprint
+        self.prevalidated = False
+        self.fingerprint = fingerprint
+        self.listChanges = 0
+        snapshot = self.getSnapshot()
+        if snapshot == None or fingerprint == None:
+            return False
+        maps = snapshot.load(fingerprint)
+        if maps == None:
+            return False
+        self.maps = maps
+        self.prevalidated = True
+        return True
+
+    def saveSnapshot(self, maps):
+        snapshot = self.getSnapshot()
+        if snapshot != None and self.fingerprint != None:
+            snapshot.write(self.fingerprint, maps)
+
+    def getTimeIndex(self):
+        # the index is rebuilt if the map list was replaced as a whole
+        if self.timeIndex == None or self.timeIndex.source is not self.maps:
+            self.timeIndex = TimeIndex(self.maps)
+        return self.timeIndex
+
+    def getListVersion(self):
+        # identifies the map list for the caches derived from it: the
+        # fingerprint of the list it was loaded from while it is unchanged,
+        # otherwise a digest over the maps
+        if self.fingerprint != None and self.listChanges == 0:
+            return CatalogueSnapshot.getKey(self.fingerprint) + ':' + str(len(self.maps))
+        return TrigramIndex.getVersion(self.maps)
+
+    def addMap(self, m):
+        self.listChanges = self.listChanges + 1
+        self.maps.append(m)
+        if self.timeIndex != None and self.timeIndex.source is self.maps:
+            self.timeIndex.add(m)
+
+    def removeMap(self, m):
+        self.listChanges = self.listChanges + 1
+        self.maps.remove(m)
+        if self.timeIndex != None and self.timeIndex.source is self.maps:
+            self.timeIndex.remove(m)
+
+    def getFilterCandidates(self):
+        # narrow the maps down to those which can pass the time and substring
+        # filters, the caller still has to apply the filter to each candidate
+        candidates = None
+        if Filter.time_before != None or Filter.time_after != None:
+            candidates = self.getTimeIndex().range(Filter.time_after, Filter.time_before)
+        if Config.settings['trigramIndex'] and Filter.hasStringFilters():
+            index = TrigramIndex.load(self.getCacheFileName('trigrams-' + self.name + '.json'), self.maps, self.getListVersion())
+            matches = index.candidates(self.maps, Filter)
+            if candidates == None:
+                candidates = matches
+            elif matches is not self.maps:
+                ids = set(id(m) for m in matches)
+                candidates = [m for m in candidates if id(m) in ids]
+        return self.maps if candidates == None else candidates
 
     def findMapById(self, mapId):
         for m in self.maps:
@@ -298,13 +710,13 @@ class MapManager:
             else:
                 raise OlmappyValidationError('missing URL')
             if 'mtime' not in m:
-                Warn(self.name + ' map ' + mapName(m) + ' has missing mtime, faking it')
+                Warn('%s map %s has missing mtime, faking it', self.name, LazyMapName(m))
                 m['mtime'] = self.timestamp
             if 'size' in m:
                 if m['size'] < 1:
                     raise OlmappyValidationError('invalid map size: ' + str(m['size']))
             else:
-                Warn(self.name + ' map ' + mapName(m) + ' has missing size')
+                Warn('%s map %s has missing size', self.name, LazyMapName(m))
                 m['size'] = -1 # will later be updated after download
             if 'levels' not in m:
                 raise OlmappyValidationError('LEVELS part missing')
@@ -328,55 +740,455 @@ class MapManager:
                 m['hidden'] = 0
 
         except Exception as E:
-            Warn('failed to validate ' +self.name + ' map ' +str(m) + ': ' + str(E))
+            # only the URL identifies the entry, the record may be large
+            url = m.get('url') if isinstance(m, dict) else None
+            Warn('failed to validate %s map %s: %s', self.name, url if isinstance(url, str) else '(without URL)', E)
             return False
         return True
 
     def compareMaps(self, a, b):
         if a['mtime'] != b['mtime']:
-            Debug('maps ' + mapName(a) + ' and ' + mapName(b) + ' differ in mtime')
+            Debug('maps %s and %s differ in mtime', LazyMapName(a), LazyMapName(b))
             return False
         if a['levels'] != b['levels']:
-            Debug('maps ' + mapName(a) + ' and ' + mapName(b) + ' differ in levels specification')
+            Debug('maps %s and %s differ in levels specification', LazyMapName(a), LazyMapName(b))
             return False
         if (a['size'] != b['size']) or a['size'] < 1 or b['size'] < 1:
-            Debug('maps ' + mapName(a) + ' and ' + mapName(b) + ' differ in size')
+            Debug('maps %s and %s differ in size', LazyMapName(a), LazyMapName(b))
             return False
         return True
 
     @staticmethod
+    @Profiled('save map list')
     def writeMapList(filename, mapList):
+        # the list is written to a temporary file first and then atomically
+        # replaces the old one, so readers never see a partial file
         try:
-            indexFile = open(file = filename, mode = 'wt', encoding = 'utf-8')
+            indexFile = open(file = filename + '.tmp', mode = 'wt', encoding = 'utf-8')
             try:
                 json.dump(mapList, indexFile, indent=4)
+                Background.io(indexFile.tell())
+                indexFile.close()
+                os.replace(filename + '.tmp', filename)
                 Debug('wrote json map list ' + filename + ': ' + str(len(mapList)) + ' entries')
             except Exception as E:
+                indexFile.close()
                 raise OlmappyJSONWriteError('failed to write map list to json file ' + filename + ': ' + str(E)) from E
         except Exception as E:
                 Warn('json map list ' + filename + ' could not be written: ' + str(E))
+                return False
+        return True
+
+    @classmethod
+    def selectMaps(cls, maps, order, limit):
+        # with a limit, only a heap of the best limit entries is kept
+        keys = cls.parseSortOrder(order)
+        def compare(a, b):
+            for name, reverse in keys:
+                ka = cls.sortKeys[name](a)
+                kb = cls.sortKeys[name](b)
+                if ka != kb:
+                    res = -1 if ka < kb else 1
+                    return -res if reverse else res
+            return 0
+        if limit != None:
+            return heapq.nsmallest(limit, maps, key = functools.cmp_to_key(compare))
+        return sorted(maps, key = functools.cmp_to_key(compare))
 
     def listMaps(self, doExport=False):
         name = 'EXPORTLIST' if doExport else 'LIST'
         cntListed = 0
-        cntFiltered = 0
-        exported = []
-        for m in self.maps:
-            if not Filter.apply(m):
-                cntFiltered = cntFiltered + 1
-                continue
-            if doExport:
-                exported = exported + [m]
+        fmt = Cmd.args.format[0] if Cmd.args.format != None else ('json' if doExport else 'text')
+        if doExport and Cmd.args.format == None and os.path.splitext(Cmd.args.export_file[0])[1] in ['.ndjson', '.jsonl']:
+            fmt = 'ndjson'
+        # check the arguments before the export file is truncated
+        MapListWriter.checkFormat(fmt)
+        limit = Cmd.args.limit[0] if Cmd.args.limit != None else None
+        keys = self.parseSortOrder(Cmd.args.sort[0]) if Cmd.args.sort != None else []
+        cntMatched = 0
+        def matching(maps):
+            nonlocal cntMatched
+            for m in maps:
+                if Filter.apply(m):
+                    cntMatched = cntMatched + 1
+                    yield m
+        if len(keys) == 1 and keys[0][0] == 'mtime':
+            # newest or oldest maps first: walk the time index, no sorting needed
+            ordered = self.getTimeIndex().ordered(keys[0][1], Filter.time_after, Filter.time_before)
+            matches = matching(ordered)
+            selected = matches if limit == None else itertools.islice(matches, limit)
+        else:
+            matches = matching(self.getFilterCandidates())
+            if Cmd.args.sort != None:
+                selected = self.selectMaps(matches, Cmd.args.sort[0], limit)
             else:
-                print(mapDesc(m))
-            cntListed = cntListed + 1
+                selected = matches if limit == None else itertools.islice(matches, limit)
         if doExport:
-            self.writeMapList(Cmd.args.export_file[0], exported)
+            outFile = open(file = Cmd.args.export_file[0], mode = 'wt', encoding = 'utf-8', newline = '')
+        else:
+            outFile = sys.stdout
+        try:
+            writer = MapListWriter(outFile, fmt)
+            batchSize = Config.settings['importBatchSize']
+            for m in selected:
+                writer.write(m)
+                cntListed = cntListed + 1
+                if doExport and cntListed % batchSize == 0:
+                    Info(name + ': ' + str(cntListed) + ' maps exported')
+            writer.close()
+        finally:
+            if doExport:
+                outFile.close()
+        # count the maps which passed the filter but were cut by --limit
+        for m in matches:
+            pass
+        cntLimited = cntMatched - cntListed
+        cntFiltered = len(self.maps) - cntListed - cntLimited
 
         if doExport:
-           Info(name + ': ' + str(cntListed) + ' exported, ' + str(cntFiltered) + ' not exported')
+           Info(name + ': ' + str(cntListed) + ' exported, ' + str(cntFiltered) + ' filtered, ' + str(cntLimited) + ' over the limit')
         else:
-           Debug(name + ': ' + str(cntListed) + ' found, ' + str(cntFiltered) + ' filtered')
+           Debug(name + ': ' + str(cntListed) + ' found, ' + str(cntFiltered) + ' filtered, ' + str(cntLimited) + ' over the limit')
+
+##############################################################################
+# class for writing map lists                                                #
+##############################################################################
+
+class MapListWriter:
+    formats = ['text', 'json', 'ndjson', 'csv']
+    csvColumns = ['id', 'filename', 'types', 'names', 'mtime', 'size', 'hidden', 'url']
+
+    def __init__(self, outFile, fmt):
+        self.checkFormat(fmt)
+        self.outFile = outFile
+        self.fmt = fmt
+        self.cnt = 0
+        if fmt == 'csv':
+            self.csv = csv.writer(outFile)
+            self.csv.writerow(self.csvColumns)
+
+    @classmethod
+    def checkFormat(cls, fmt):
+        if fmt not in cls.formats:
+            raise OlmappyParseError('unknown output format "' + fmt + '", must be one of: ' + ', '.join(cls.formats))
+
+    def write(self, m):
+        if self.fmt == 'text':
+            self.outFile.write(mapDesc(m) + '\n')
+        elif self.fmt == 'ndjson':
+            self.outFile.write(json.dumps(m) + '\n')
+        elif self.fmt == 'csv':
+            self.csv.writerow([m['id'], m['filename'], mapTypes(m, True), '|'.join(m['names']), m['mtime'], m['size'], m['hidden'], m['url']])
+        else:
+            # same layout as json.dump(mapList, indent=4), one entry at a time
+            self.outFile.write(('[\n' if self.cnt == 0 else ',\n') + '    ' + json.dumps(m, indent=4).replace('\n', '\n    '))
+        self.cnt = self.cnt + 1
+
+    def close(self):
+        if self.fmt == 'json':
+            self.outFile.write('[]' if self.cnt == 0 else '\n]')
+        self.outFile.flush()
+
+##############################################################################
+# class for inspecting local map archives                                    #
+##############################################################################
+
+class MapArchiveInspector:
+    # level descriptors inside the map zip files, by file extension
+    levelTypes = {
+        '.sp': MapType.SinglePlayer,
+        '.mission': MapType.SinglePlayer,
+        '.cm': MapType.ChallengeMode,
+        '.mp': MapType.MultiPlayer
+    }
+
+    def __init__(self, cacheFile):
+        self.cacheFile = cacheFile
+        self.cache = None
+        self.dirty = False
+        self.cntHit = 0
+        self.cntMiss = 0
+
+    def loadCache(self):
+        if self.cache != None:
+            return
+        self.cache = {}
+        try:
+            cf = open(file = self.cacheFile, mode = 'rt', encoding = 'utf-8')
+            self.cache = json.load(cf)
+            cf.close()
+            Debug('read archive cache ' + self.cacheFile + ': ' + str(len(self.cache)) + ' entries')
+        except FileNotFoundError:
+            pass
+        except Exception as E:
+            Warn('archive cache ' + self.cacheFile + ' could not be read: ' + str(E))
+
+    def saveCache(self):
+        if self.cache == None or not self.dirty:
+            return
+        try:
+            cf = open(file = self.cacheFile, mode = 'wt', encoding = 'utf-8')
+            json.dump(self.cache, cf)
+            Background.io(cf.tell())
+            cf.close()
+            self.dirty = False
+            Debug('wrote archive cache ' + self.cacheFile + ': ' + str(len(self.cache)) + ' entries, ' + str(self.cntHit) + ' hits, ' + str(self.cntMiss) + ' misses')
+        except Exception as E:
+            Warn('archive cache ' + self.cacheFile + ' could not be written: ' + str(E))
+
+    @classmethod
+    def readLevels(cls, filename):
+        # only the central directory of the zip file is read here
+        levels = []
+        try:
+            archive = zipfile.ZipFile(filename, 'r')
+        except zipfile.BadZipFile:
+            return None
+        try:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                base = info.filename.split('/')[-1]
+                idx = base.rfind('.')
+                if idx < 1:
+                    continue
+                t = cls.levelTypes.get(base[idx:].casefold())
+                if t == None:
+                    continue
+                l = {'type': t.getDesc().lower(), 'name': base[0:idx].replace('_', ' ').upper()}
+                if l not in levels:
+                    levels.append(l)
+        finally:
+            archive.close()
+        levels.sort(key = lambda l: (MapType.MapTypeString(l['type']), l['name']))
+        return levels
+
+    @Profiled('inspect archive')
+    def inspect(self, filename, key):
+        st = os.stat(filename)
+        self.loadCache()
+        entry = self.cache.get(key)
+        if entry != None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            self.cntHit = self.cntHit + 1
+            Metrics.inc('olmappy_archive_cache_lookups', 1, {'result': 'hit'}, 'archive metadata cache lookups of this run')
+            return entry
+        self.cntMiss = self.cntMiss + 1
+        Metrics.inc('olmappy_archive_cache_lookups', 1, {'result': 'miss'}, 'archive metadata cache lookups of this run')
+        Background.step()
+        entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'levels': self.readLevels(filename)}
+        self.cache[key] = entry
+        self.dirty = True
+        return entry
+
+    @staticmethod
+    @Profiled('check archive')
+    def checkArchive(filename):
+        # validates the end of central directory record and the CRCs of all entries
+        Background.read(filename)
+        Background.step()
+        try:
+            archive = zipfile.ZipFile(filename, 'r')
+        except Exception as E:
+            return 'no valid end of central directory record: ' + str(E)
+        try:
+            bad = archive.testzip()
+            if bad != None:
+                return 'CRC mismatch in entry "' + bad + '"'
+        except Exception as E:
+            return 'entry data corrupted: ' + str(E)
+        finally:
+            archive.close()
+        return None
+
+    @staticmethod
+    def levelsDesc(levels):
+        if levels == None or len(levels) < 1:
+            return '(no map archive)'
+        types = 0
+        names = []
+        for l in levels:
+            types = types | MapType.MapTypeString(l['type'])
+            if l['name'] not in names:
+                names.append(l['name'])
+        return '["' + '", "'.join(names) + '"] ' + MapType.getCombinedDesc(types, None)
+
+##############################################################################
+# class for binary snapshots of validated map lists                          #
+##############################################################################
+
+class CatalogueSnapshot:
+    # Layout (little endian): header, fingerprint, string table offsets and
+    # data, then one array per column, each padded to 8 bytes. Strings are
+    # stored once and referenced by index; everything of a record which has
+    # no column of its own is kept as a json string in the 'extra' column,
+    # and the 'keys' column keeps the original order of the keys.
+    magic = b'OLMS'
+    version = 1
+    header = struct.Struct('<4sIIIIII')
+    strColumns = ['url', 'id', 'filename_encoded', 'filename']
+    intColumns = ['size', 'types', 'hidden']
+    knownKeys = set(strColumns + intColumns + ['mtime', 'levels', 'names'])
+    MTIME_INT = 1
+    LEVELS_EXTRA = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def padded(data):
+        return data + bytes(-len(data) % 8)
+
+    @staticmethod
+    def getKey(fingerprint):
+        # the validated list also depends on the settings used to dedupe it
+        return fingerprint + '/' + ('casefold' if Config.settings['filenameCaseSensitive'] else 'exact')
+
+    def write(self, fingerprint, maps):
+        try:
+            parts = self.encode(self.getKey(fingerprint), maps)
+        except Exception as E:
+            Debug('snapshot %s not written, the map list can\'t be stored in it: %s', self.filename, E)
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            f = open(self.filename + '.tmp', 'wb')
+            for p in parts:
+                f.write(self.padded(p))
+            Background.io(f.tell())
+            f.close()
+            os.replace(self.filename + '.tmp', self.filename)
+            Debug('wrote snapshot %s: %d entries', self.filename, len(maps))
+        except Exception as E:
+            Warn('snapshot ' + self.filename + ' could not be written: ' + str(E))
+
+    def encode(self, fingerprint, maps):
+        # raises if a record can't be restored exactly from the columns
+        strings = {}
+        table = []
+        def intern(s):
+            idx = strings.get(s)
+            if idx == None:
+                idx = len(table)
+                strings[s] = idx
+                table.append(s)
+            return idx
+        cols = {}
+        for c in self.strColumns + self.intColumns + ['flags', 'extra', 'keys', 'levelEnd', 'nameEnd']:
+            cols[c] = array.array('q')
+        mtimes = array.array('d')
+        levelTypes = array.array('q')
+        levelNames = array.array('q')
+        names = array.array('q')
+        for m in maps:
+            for c in self.strColumns:
+                if type(m[c]) is not str:
+                    raise ValueError(c + ' ' + repr(m[c]) + ' is not a string')
+                cols[c].append(intern(m[c]))
+            for c in self.intColumns:
+                if not isinstance(m[c], int) or type(m[c]) is bool:
+                    raise ValueError(c + ' ' + repr(m[c]) + ' is not an integer')
+                cols[c].append(m[c])
+            if type(m['mtime']) is int:
+                if int(float(m['mtime'])) != m['mtime']:
+                    raise ValueError('mtime ' + str(m['mtime']) + ' has no exact float value')
+                flags = self.MTIME_INT
+            elif type(m['mtime']) is float:
+                flags = 0
+            else:
+                raise ValueError('mtime ' + repr(m['mtime']) + ' is not a number')
+            mtimes.append(m['mtime'])
+            extra = {k: v for k, v in m.items() if k not in self.knownKeys}
+            if all(type(l['type']) is str and type(l['name']) is str and len(l) == 2 for l in m['levels']):
+                for l in m['levels']:
+                    levelTypes.append(intern(l['type']))
+                    levelNames.append(intern(l['name']))
+            else:
+                flags = flags | self.LEVELS_EXTRA
+                extra['levels'] = m['levels']
+            cols['levelEnd'].append(len(levelTypes))
+            for n in m['names']:
+                names.append(intern(n))
+            cols['nameEnd'].append(len(names))
+            cols['flags'].append(flags)
+            cols['extra'].append(intern(json.dumps(extra)) if len(extra) > 0 else -1)
+            if any('\n' in k for k in m):
+                raise ValueError('key with a line break')
+            cols['keys'].append(intern('\n'.join(m)))
+        blob = bytearray()
+        offsets = array.array('q', [0])
+        for s in table:
+            blob.extend(s.encode('utf-8'))
+            offsets.append(len(blob))
+        fp = fingerprint.encode('utf-8')
+        parts = [self.header.pack(self.magic, self.version, len(fp), len(maps), len(table), len(levelTypes), len(names)), self.padded(fp), offsets.tobytes(), self.padded(bytes(blob))]
+        for c in self.strColumns + self.intColumns + ['flags', 'extra', 'keys', 'levelEnd', 'nameEnd']:
+            parts.append(cols[c].tobytes())
+        return parts + [mtimes.tobytes(), levelTypes.tobytes(), levelNames.tobytes(), names.tobytes()]
+
+    @Profiled('load snapshot')
+    def load(self, fingerprint):
+        # returns the records, or None if there is no snapshot for fingerprint
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            with f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+                return self.decode(memoryview(mm), self.getKey(fingerprint))
+        except Exception as E:
+            Warn('snapshot ' + self.filename + ' could not be read: ' + str(E))
+            return None
+
+    def decode(self, view, fingerprint):
+        magic, version, fpLen, n, numStrings, numLevels, numNames = self.header.unpack_from(view, 0)
+        pos = self.header.size + (-self.header.size % 8)
+        if magic != self.magic or version != self.version:
+            return None
+        fp = bytes(view[pos:pos+fpLen]).decode('utf-8')
+        if fp != fingerprint:
+            Debug('snapshot %s is outdated', self.filename)
+            return None
+        pos = pos + fpLen + (-fpLen % 8)
+        def column(fmt, count):
+            nonlocal pos
+            a = array.array(fmt)
+            a.frombytes(view[pos:pos + count * a.itemsize])
+            pos = pos + count * a.itemsize
+            pos = pos + (-pos % 8)
+            return a
+        offsets = column('q', numStrings + 1)
+        blob = bytes(view[pos:pos + offsets[-1]])
+        pos = pos + offsets[-1] + (-offsets[-1] % 8)
+        table = [blob[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(numStrings)]
+        cols = {}
+        for c in self.strColumns + self.intColumns + ['flags', 'extra', 'keys', 'levelEnd', 'nameEnd']:
+            cols[c] = column('q', n)
+        mtimes = column('d', n)
+        levelTypes = column('q', numLevels)
+        levelNames = column('q', numLevels)
+        names = column('q', numNames)
+        maps = []
+        levelStart = 0
+        nameStart = 0
+        for i in range(n):
+            m = {}
+            for c in self.strColumns:
+                m[c] = table[cols[c][i]]
+            flags = cols['flags'][i]
+            m['mtime'] = int(mtimes[i]) if flags & self.MTIME_INT else mtimes[i]
+            for c in self.intColumns:
+                m[c] = cols[c][i]
+            levelEnd = cols['levelEnd'][i]
+            m['levels'] = [{'type': table[levelTypes[j]], 'name': table[levelNames[j]]} for j in range(levelStart, levelEnd)]
+            levelStart = levelEnd
+            nameEnd = cols['nameEnd'][i]
+            m['names'] = [table[names[j]] for j in range(nameStart, nameEnd)]
+            nameStart = nameEnd
+            if cols['extra'][i] >= 0:
+                m.update(json.loads(table[cols['extra'][i]]))
+            maps.append({k: m[k] for k in table[cols['keys'][i]].split('\n')})
+        Debug('read snapshot %s: %d entries', self.filename, n)
+        return maps
 
 ##############################################################################
 # class for managing the locally stored maps                                 #
@@ -389,7 +1201,11 @@ class localMapManager(MapManager):
         self.indexName = 'olmappyIndex.json'
         self.hiddenDir = 'hidden/'
         self.replaceDir = 'replaced/'
+        self.cacheDir = 'cache/'
         self.mapDir = './'
+        self.archives = None
+        self.replaced = None
+        self.replacedDirty = False
 
     def update(self, forceRefresh = False):
         if self.mapDir != Config.settings['mapPath']:
@@ -401,7 +1217,11 @@ class localMapManager(MapManager):
             os.makedirs(self.mapDir, exist_ok=True)
             os.makedirs(self.mapDir + self.hiddenDir, exist_ok=True)
             os.makedirs(self.mapDir + self.replaceDir, exist_ok=True)
+            os.makedirs(self.mapDir + self.cacheDir, exist_ok=True)
+            self.archives = None
+            self.replaced = None
             self.loadMapList()
+            self.recoverIntentLog()
             self.validateMapList()
 
     def getMapListFileName(self):
@@ -427,13 +1247,110 @@ class localMapManager(MapManager):
             valid = True
         return mapList, valid
 
+    def getIndexFingerprint(self):
+        try:
+            st = os.stat(self.getMapListFileName())
+        except FileNotFoundError:
+            return None
+        return 'index:' + str(st.st_size) + ':' + str(st.st_mtime_ns)
+
+    @Profiled('load index')
     def loadMapList(self):
         filename = self.getMapListFileName()
+        if self.loadSnapshot(self.getIndexFingerprint()):
+            self.valid = True
+            return
         self.maps , self.valid = self.loadMapListFile(filename, self.valid)
 
     def saveMapList(self):
-        self.writeMapList(self.getMapListFileName(), self.maps)
+        res = self.writeMapList(self.getMapListFileName(), self.maps)
+        if res:
+            self.fingerprint = self.getIndexFingerprint()
+            self.listChanges = 0
+            self.saveSnapshot(self.maps)
+        self.updateMetrics()
+        self.saveReplacedIndex()
+        return res
+
+    def getArchiveInspector(self):
+        if self.archives == None:
+            self.archives = MapArchiveInspector(self.mapDir + self.cacheDir + 'archives.json')
+        return self.archives
+
+    def saveArchiveCache(self):
+        if self.archives != None:
+            self.archives.saveCache()
+
+    def getOfflineMap(self, d, fname, hidden=0):
+        fullname = d + fname
+        entry = self.getArchiveInspector().inspect(fullname, fullname[len(self.mapDir):])
+        if entry['levels'] == None or len(entry['levels']) < 1:
+            return None
+        if hidden > 0:
+            filename = self.RemoveFilenameDecoration(fname)
+            if filename == None:
+                return None
+        else:
+            filename = fname
+        fingerprint = filename + '/' + str(entry['size']) + '/' + str(entry['mtime_ns'])
+        m = {}
+        m['id'] = hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+        m['filename'] = filename
+        m['url'] = '/' + m['id'] + '/' + urllib.parse.quote(filename)
+        m['mtime'] = entry['mtime_ns'] // 1000000000
+        m['size'] = entry['size']
+        m['levels'] = entry['levels']
+        m['hidden'] = hidden
+        m['offline'] = 1
+        if not MapManager.validateMap(self, m):
+            return None
+        return m
+
+    @staticmethod
+    def getSizeIndex(remote):
+        bySize = {}
+        for m in remote.maps:
+            bySize.setdefault(m['size'], []).append(m)
+        return bySize
+
+    @staticmethod
+    def levelsKey(levels):
+        return sorted((l['type'].casefold(), l['name'].casefold()) for l in levels)
 
+    def findRenamedMap(self, fullname, bySize):
+        # identify a file with an unknown name by its size and the levels in
+        # the archive, returns the remote map if exactly one of them matches
+        if bySize == None:
+            return None
+        candidates = [m for m in bySize.get(os.stat(fullname).st_size, []) if self.findMapById(m['id']) == None]
+        if len(candidates) < 1:
+            return None
+        entry = self.getArchiveInspector().inspect(fullname, fullname[len(self.mapDir):])
+        if entry['levels'] == None or len(entry['levels']) < 1:
+            return None
+        levels = self.levelsKey(entry['levels'])
+        matches = [m for m in candidates if self.levelsKey(m['levels']) == levels]
+        if len(matches) != 1:
+            if len(matches) > 1:
+                Info('file "' + fullname + '" matches ' + str(len(matches)) + ' remote maps, not identifying it')
+            return None
+        return matches[0]
+
+    def adoptOfflineMap(self, myMap, m):
+        Info('adopting offline imported map ' + mapName(myMap) + ' as ' + mapName(m))
+        if myMap['hidden'] > 0:
+            src = self.GetMapPath(myMap)
+            dst = self.GetMapPathAs(m, hidden=True)
+            if src != dst:
+                self.RenameMap(src, dst)
+        for key in ['url', 'id', 'filename_encoded', 'filename', 'mtime', 'levels', 'names', 'types']:
+            myMap[key] = m[key]
+        del myMap['offline']
+        if self.timeIndex != None and self.timeIndex.source is self.maps:
+            self.timeIndex.update(myMap)
+        return myMap
+
+    @Profiled('replace')
     def doActualReplace(self, src, dst):
         try:
             Warn('Replace File "' + src + '" to "' + dst + '"')
@@ -441,6 +1358,8 @@ class localMapManager(MapManager):
             index = 1
             while True:
                 if os.path.isfile(target):
+                    Background.read(src, target)
+                    Background.step()
                     if filecmp.cmp(src, target, shallow=False):
                         Warn('Target "' + target + '" already exists and is identical, removing source only')
                         os.remove(src)
@@ -452,16 +1371,105 @@ class localMapManager(MapManager):
                         target = newtarget
                 else:
                     os.rename(src,target)
+                    self.addReplacedFile(target)
                     break
         except Exception as E:
             Warn('Failed to replace "' + src + '" to "' + dst + '": ' + str(E))
             raise E
 
+    def getReplacedIndexFileName(self):
+        return self.mapDir + self.cacheDir + 'replaced.json'
+
+    @staticmethod
+    def getReplacedEntry(st):
+        # size and time of the replacement: the rename into the replaced
+        # directory updates the ctime, while the mtime stays the one of the map
+        return [st.st_size, st.st_ctime]
+
+    def scanReplacedDir(self):
+        d = self.mapDir + self.replaceDir
+        entries = {}
+        for e in os.scandir(d):
+            if e.is_file(follow_symlinks=False):
+                entries[e.name] = self.getReplacedEntry(e.stat(follow_symlinks=False))
+        Debug('scanned replaced directory "' + d + '": ' + str(len(entries)) + ' files')
+        return entries
+
+    def getReplacedIndex(self):
+        if self.replaced == None:
+            filename = self.getReplacedIndexFileName()
+            try:
+                f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+                self.replaced = json.load(f)
+                f.close()
+            except Exception as E:
+                if not isinstance(E, FileNotFoundError):
+                    Warn('replaced index ' + filename + ' could not be read: ' + str(E))
+                self.replaced = self.scanReplacedDir()
+                self.replacedDirty = True
+        return self.replaced
+
+    def saveReplacedIndex(self):
+        if self.replaced == None or not self.replacedDirty:
+            return
+        filename = self.getReplacedIndexFileName()
+        try:
+            f = open(file = filename, mode = 'wt', encoding = 'utf-8')
+            json.dump(self.replaced, f)
+            Background.io(f.tell())
+            f.close()
+            self.replacedDirty = False
+        except Exception as E:
+            Warn('replaced index ' + filename + ' could not be written: ' + str(E))
+
+    def addReplacedFile(self, filename):
+        entries = self.getReplacedIndex()
+        entries[os.path.basename(filename)] = self.getReplacedEntry(os.stat(filename))
+        self.replacedDirty = True
+
+    def pruneReplaced(self):
+        maxSize = Config.settings['replacedMaxSize'] * 1024 * 1024
+        maxAge = Config.settings['replacedMaxAge'] * 24 * 3600
+        if maxSize < 1 and maxAge < 1:
+            Info('PRUNE: no budget for the replaced maps configured, see replacedMaxSize and replacedMaxAge')
+            return
+        d = self.mapDir + self.replaceDir
+        entries = self.getReplacedIndex()
+        total = 0
+        for size, t in entries.values():
+            total = total + size
+        cntRemoved = 0
+        cntFail = 0
+        bytesRemoved = 0
+        limit = time.time() - maxAge
+        # oldest first, stop as soon as the budget is met
+        for name, (size, t) in sorted(entries.items(), key = lambda e: e[1][1]):
+            if (maxAge < 1 or t >= limit) and (maxSize < 1 or total <= maxSize):
+                break
+            try:
+                os.remove(d + name)
+                Debug('PRUNE: removed "%s%s"', d, name)
+                cntRemoved = cntRemoved + 1
+                bytesRemoved = bytesRemoved + size
+            except FileNotFoundError:
+                Debug('PRUNE: "' + d + name + '" is already gone')
+            except Exception as E:
+                Warn('PRUNE: failed to remove "' + d + name + '": ' + str(E))
+                cntFail = cntFail + 1
+                continue
+            total = total - size
+            del entries[name]
+            self.replacedDirty = True
+        self.saveReplacedIndex()
+        Info('PRUNE: ' + str(cntRemoved) + ' removed (' + str(bytesRemoved) + ' bytes), ' + str(len(entries)) + ' kept (' + str(total) + ' bytes), ' + str(cntFail) + ' failed to remove')
+
 
+    @Profiled('rename')
     def RenameMap(self, src, dst):
         try:
             os.rename(src,dst)
-            Debug('renamed "' + src + '" to "' + dst + '"')
+            Debug('renamed "%s" to "%s"', src, dst)
+            Background.step()
         except Exception as E:
             Warn('Failed to rename "' + src + '" to "' + dst + '": ' + str(E))
             raise E
@@ -483,21 +1491,30 @@ class localMapManager(MapManager):
         except Exception as E:
             Warn('Failed to back up replaced map ' + mapName(m) + ': ' + str(E))
 
-    def findAndReplaceExistingMap(self, m):
+    def findExistingMap(self, m):
+        # returns the existing map for m, or the conflicting map which has
+        # to be replaced by m
         myMapId = self.findMapById(m['id'])
         myMapFile = self.findMapByFileName(m['filename'])
         if myMapId == None and myMapFile == None:
-            return None
+            return None, None
         elif myMapId == myMapFile:
-            return myMapId
+            return myMapId, None
+        elif myMapId == None and 'offline' in myMapFile and 'offline' not in m and myMapFile['size'] == m['size']:
+            return self.adoptOfflineMap(myMapFile, m), None
         else:
             replaceMap = myMapId
             if myMapId == None:
                 replaceMap = myMapFile
-            Warn('found map: ' + mapName(m) + ' conflicting with existing map ' + mapName(replaceMap)+ ', replacing it')
+            return None, replaceMap
+
+    def findAndReplaceExistingMap(self, m):
+        myMap, replaceMap = self.findExistingMap(m)
+        if replaceMap != None:
+            Warn('found map: %s conflicting with existing map %s, replacing it', LazyMapName(m), LazyMapName(replaceMap))
             self.doReplaceMap(replaceMap)
-            self.maps.remove(replaceMap)
-            return None
+            self.removeMap(replaceMap)
+        return myMap
 
     def GetMapPathAs(self, m, hidden=False, replaced = False):
         d = self.mapDir
@@ -514,6 +1531,9 @@ class localMapManager(MapManager):
     def validateMap(self, m):
         if not MapManager.validateMap(self, m):
             return False
+        return self.validateMapFile(m)
+
+    def validateMapFile(self, m):
         try:
             if 'filename_encoded' not in m:
                 raise OlmappyValidationError('FILENAME part missing')
@@ -532,7 +1552,9 @@ class localMapManager(MapManager):
                 filename2 = self.GetMapPathAs(m, hidden=True)
             try:
                 fsize2 = os.stat(filename2).st_size
-                Debug('file "' + filename2 + '" present but should be shadowed by "' + filename +'"')
+                Debug('file "%s" present but should be shadowed by "%s"', filename2, filename)
+                Background.read(filename, filename2)
+                Background.step()
                 if filecmp.cmp(filename, filename2, shallow=False):
                     Info('deleting "' + filename2 + '" as we already have "' + filename + '"')
                     os.remove(filename2)
@@ -543,22 +1565,32 @@ class localMapManager(MapManager):
                 pass 
 
         except Exception as E:
-            Warn('Failed to validate ' + self.name + ' map ' + str(m) + ': ' + str(E))
+            Warn('Failed to validate %s map %s: %s', self.name, m, E)
             return False
         return True
 
+    @Profiled('validate index')
     def validateMapList(self):
         numEntries = len(self.maps)
         numValidated = 0
         mapsValidated = []
+        mapsParsed = []
         Debug(self.name + ' map list: validating ' + str(numEntries) + ' entries')
         for m in self.maps:
-            if self.validateMap(m):
+            # entries from a snapshot only need to be checked against the files
+            if not self.prevalidated:
+                if not MapManager.validateMap(self, m):
+                    continue
+                mapsParsed.append(m)
+            if self.validateMapFile(m):
                 mapsValidated = mapsValidated + [m]
                 numValidated = numValidated + 1
+        if not self.prevalidated:
+            self.saveSnapshot(mapsParsed)
         Debug(self.name + ' map list: validated ' + str(numValidated) + ' out of ' + str(numEntries) + ' entries')
         if (numValidated < numEntries) :
             Warn(self.name + ' map list: ' + str(numEntries - numValidated) + ' entries were not correct')
+        Metrics.set('olmappy_validation_failures', numEntries - numValidated, {'list': self.name}, 'map list entries which failed to validate')
         self.maps = []
         for m in mapsValidated:
             myMap = self.findAndReplaceExistingMap(m)
@@ -566,65 +1598,162 @@ class localMapManager(MapManager):
                 self.maps = self.maps + [m]
             else:
                 if self.compareMaps(m,myMap):
-                    Warn(self.name + ' map ' + mapName(myMap) + ' is already present, ignoring duplicate ' + mapName(m))
+                    Warn('%s map %s is already present, ignoring duplicate %s', self.name, LazyMapName(myMap), LazyMapName(m))
                 else:
-                    Warn(self.name + ' map ' + mapName(myMap) + ' is already present, ignoring conflicting ' + mapName(m))
+                    Warn('%s map %s is already present, ignoring conflicting %s', self.name, LazyMapName(myMap), LazyMapName(m))
         Debug(self.name + ' map list: found ' + str(len(self.maps)) + ' unique entries')
         if len(self.maps) < 1:
             self.valid = False
+        self.updateMetrics()
 
-    def updateMapFromRemote(self, m, remote):
-        myMap = self.findAndReplaceExistingMap(m)
-        myMapId = self.findMapById(m['id'])
-        myMapFile = self.findMapByFileName(m['filename'])
-        doUpdate = False
-        code = 0
+    def updateMetrics(self):
+        cntHidden = 0
+        for m in self.maps:
+            if m['hidden'] > 0:
+                cntHidden = cntHidden + 1
+        Metrics.set('olmappy_local_maps', len(self.maps) - cntHidden, {'state': 'visible'}, 'locally indexed maps')
+        Metrics.set('olmappy_local_maps', cntHidden, {'state': 'hidden'})
+
+    def prepareMapFromRemote(self, m):
+        # returns the kind of download needed and the existing maps which
+        # are to be replaced once the download has been verified
+        myMap, replaceMap = self.findExistingMap(m)
+        if replaceMap != None:
+            Warn('found map: %s conflicting with existing map %s, replacing it', LazyMapName(m), LazyMapName(replaceMap))
+            return 1, [replaceMap]
         if myMap == None:
             Info('found NEW map: ' + mapName(m))
-            doUpdate = True
-            code = 1
+            return 1, []
+        Debug('found existing map: %s', LazyMapName(myMap))
+        if  self.compareMaps(m, myMap):
+            Debug('existing Map is unchanged')
+            return 0, []
+        m['hidden'] = myMap['hidden']
+        Info('found UPDATED map: ' + mapName(m))
+        return 2, [myMap]
+
+    def getPartialPath(self, m):
+        return self.mapDir + self.cacheDir + m['id'] + '_' + m['filename'] + '.part'
+
+    def getAvailableSpace(self):
+        # the free space for downloads, or None if it can't be determined
+        try:
+            free = shutil.disk_usage(self.mapDir).free
+        except Exception as E:
+            Warn('free disk space of "' + self.mapDir + '" could not be determined: ' + str(E))
+            return None
+        return free - Config.settings['diskReserve'] * 1024 * 1024
+
+    def getPendingSize(self, m, partialFile, unknownSize):
+        # a map of unknown size is assumed to be as large as unknownSize
+        try:
+            done = os.stat(partialFile).st_size
+        except FileNotFoundError:
+            done = 0
+        size = m['size'] if m['size'] > 0 else unknownSize
+        return max(size - done, 0)
+
+    def finishMapFromRemote(self, m, partialFile, replaceMaps):
+        # the old versions are only moved away once the new one is complete,
+        # so a failure leaves the installed version in place
+        fsize = os.stat(partialFile).st_size
+        if m['size'] > 0 and fsize != m['size']:
+            raise OlmappyUpdateError('downloaded map has ' + str(fsize) + ' bytes, expected ' + str(m['size']))
+        for oldMap in replaceMaps:
+            if oldMap in self.maps:
+                self.doReplaceMap(oldMap)
+                self.removeMap(oldMap)
+        os.rename(partialFile, self.GetMapPath(m))
+        if self.validateMap(m):
+            Debug('successfully added map %s', LazyMapName(m))
+            self.addMap(m)
         else:
-            Debug('found existing map: ' + mapName(myMap))
-            if  self.compareMaps(m, myMap):
-                Debug('existing Map is unchanged')
-            else:
-                m['hidden'] = myMap['hidden']
-                self.doReplaceMap(myMap)
-                self.maps.remove(myMap)
-                doUpdate = True
-                code = 2
-                Info('found UPDATED map: ' + mapName(m))
-
-        if doUpdate:
-            filename = self.GetMapPath(m)
-            Info("downloading " + mapName(m) + ' to "' + filename + '"')
-            remote.download(m, filename)
-            if self.validateMap(m):
-                Debug('successfully added map ' + mapName(m))
-                self.maps = self.maps + [m]
-                return code
-            else:
-                raise OlmappyUpdateError('downloaded map could not be validated')
+            raise OlmappyUpdateError('downloaded map could not be validated')
 
-        return 0         
+    def getCheckPool(self):
+        if not Config.settings['checkArchives']:
+            return None
+        return concurrent.futures.ThreadPoolExecutor(max_workers = Config.settings['workerThreads'])
+
+    def replaceCorruptMap(self, m, reason):
+        # the map is only moved to the replaced maps, so a false alarm does
+        # not cost the file
+        if not Config.settings['replaceCorruptMaps']:
+            Warn('map ' + mapName(m) + ' is corrupted: ' + reason)
+            return
+        Warn('map ' + mapName(m) + ' is corrupted: ' + reason + ', replacing it')
+        self.doReplaceMap(m)
+        if m in self.maps:
+            self.removeMap(m)
+
+    def collectChecks(self, checks):
+        cntCorrupt = 0
+        for m, check in checks:
+            try:
+                reason = check.result()
+            except Exception as E:
+                reason = 'check failed: ' + str(E)
+            if reason != None:
+                self.replaceCorruptMap(m, reason)
+                cntCorrupt = cntCorrupt + 1
+        return cntCorrupt
 
     def updateFromRemote(self, remote):
         cntNew = 0
         cntUp = 0
         cntFail = 0
+        cntCorrupt = 0
+        cntNoSpace = 0
         res = False
         if not remote.valid:
             Warn('UPDATE: failed due to not having a valid remote map list')
             return False
+        pool = self.getCheckPool()
+        downloads = concurrent.futures.ThreadPoolExecutor(max_workers = Config.settings['maxConnections'])
         try:
             if not remote.update():
                 raise OlmappyUpdateError('remote map list could not be updated')
-            for m in remote.maps:
-                if not Filter.apply(m):
-                    continue
+            plan = self.planFromRemote(remote, False)
+            if len(plan.excluded) > 0:
+                Info('UPDATE: %d maps excluded by the sync policy', len(plan.excluded))
+            pending = {}
+            available = self.getAvailableSpace()
+            # reserve the size of the largest known map for maps of unknown size
+            unknownSize = max([r['size'] for r in remote.maps], default = 0)
+            # the executor starts the downloads in the order they were submitted
+            for m in self.sortMaps(plan.actions, Config.settings['downloadOrder']):
                 try:
-                    code = self.updateMapFromRemote(m, remote)
+                    code, replaceMaps = self.prepareMapFromRemote(m)
                     if code > 0:
+                        partialFile = self.getPartialPath(m)
+                        if available != None:
+                            needed = self.getPendingSize(m, partialFile, unknownSize)
+                            if needed > available:
+                                Warn('not enough disk space to download %s: %d bytes needed, %d bytes available', LazyMapName(m), needed, max(available, 0))
+                                cntNoSpace = cntNoSpace + 1
+                                continue
+                            available = available - needed
+                        Info("downloading " + mapName(m) + ' to "' + self.GetMapPath(m) + '"')
+                        pending[downloads.submit(remote.download, m, partialFile)] = ('download', m, code, partialFile, replaceMaps)
+                except Exception as E:
+                    Warn('remote map ' + mapName(m) + ' could not be updated: ' + str(E))
+                    cntFail = cntFail + 1
+            # downloaded files are checked before they replace the old versions
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    step, m, code, partialFile, replaceMaps = pending.pop(future)
+                    try:
+                        result = future.result()
+                        if step == 'download' and pool != None:
+                            pending[pool.submit(MapArchiveInspector.checkArchive, partialFile)] = ('check', m, code, partialFile, replaceMaps)
+                            continue
+                        if step == 'check' and result != None:
+                            Warn('downloaded map ' + mapName(m) + ' is corrupted: ' + result + ', removing it')
+                            os.remove(partialFile)
+                            cntCorrupt = cntCorrupt + 1
+                            continue
+                        self.finishMapFromRemote(m, partialFile, replaceMaps)
                         try:
                             self.saveMapList()
                         except Exception as E:
@@ -633,20 +1762,110 @@ class localMapManager(MapManager):
                             cntNew = cntNew + 1
                         else:
                             cntUp = cntUp + 1
-                except Exception as E:
-                    Warn('remote map ' + mapName(m) + ' could not be updated: ' + str(E))
-                    cntFail = cntFail + 1
+                    except Exception as E:
+                        Warn('remote map ' + mapName(m) + ' could not be updated: ' + str(E))
+                        cntFail = cntFail + 1
 
             res = True
         except Exception as E:
             res = False
-        Info('UPDATE: ' + str(cntNew) + ' new, ' + str(cntUp) + ' updated, ' + str(cntFail) + ' failed')
+        finally:
+            # completed downloads are kept in the index, partial ones are resumed next time
+            downloads.shutdown(wait=True, cancel_futures=True)
+            if pool != None:
+                pool.shutdown(wait=True, cancel_futures=True)
+        Info('UPDATE: ' + str(cntNew) + ' new, ' + str(cntUp) + ' updated, ' + str(cntFail) + ' failed, ' + str(cntCorrupt) + ' corrupted, ' + str(cntNoSpace) + ' skipped for lack of disk space')
+        for result, cnt in [('new', cntNew), ('updated', cntUp), ('failed', cntFail), ('corrupted', cntCorrupt), ('nospace', cntNoSpace)]:
+            Metrics.set('olmappy_update_maps', cnt, {'result': result}, 'maps handled by UPDATE in this run')
         return res
 
+    @Profiled('plan')
+    def planFromRemote(self, remote, withImport = True):
+        plan = SyncPlan()
+        policy = SyncPolicy().select(remote.maps, self.maps)
+        byId = {}
+        byName = {}
+        for m in self.maps:
+            byId[m['id']] = m
+            byName[fileNameKey(m['filename'])] = m
+        importing = set()
+        if withImport:
+            remoteByName = {}
+            for m in remote.maps:
+                remoteByName[fileNameKey(m['filename'])] = m
+            bySize = self.getSizeIndex(remote) if Config.settings['renameImport'] else None
+            for d, hidden in [(self.mapDir, 0), (self.mapDir + self.hiddenDir, 1)]:
+                files, cntAlready, cntFail = self.getUnindexedFiles(d, hidden)
+                for fname in files:
+                    fname2 = self.RemoveFilenameDecoration(fname) if hidden > 0 else fname
+                    newMap = None
+                    if fname2 != None:
+                        newMap = remoteByName.get(fileNameKey(fname2))
+                    if newMap == None:
+                        newMap = self.findRenamedMap(d + fname, bySize)
+                    if newMap != None and not policy.allows(newMap):
+                        plan.excludedFiles.append(d + fname)
+                        continue
+                    if newMap != None and Config.settings['autoImport']:
+                        plan.importable.append(d + fname)
+                        importing.add(newMap['id'])
+                    else:
+                        plan.unknown.append(d + fname)
+        for m in remote.getFilterCandidates():
+            if not Filter.apply(m):
+                continue
+            if m['id'] in importing:
+                continue
+            if not policy.allows(m):
+                plan.excluded.append(m)
+                continue
+            myMapId = byId.get(m['id'])
+            myMapFile = byName.get(fileNameKey(m['filename']))
+            if myMapId == None and myMapFile == None:
+                plan.addDownload(m, plan.new)
+            elif myMapId is myMapFile:
+                if self.compareMaps(m, myMapId):
+                    plan.cntUnchanged = plan.cntUnchanged + 1
+                else:
+                    plan.replaced.append(myMapId)
+                    plan.addDownload(m, plan.updated)
+            elif myMapId == None and 'offline' in myMapFile and myMapFile['size'] == m['size']:
+                plan.adopted.append(m)
+                plan.actions.append(m)
+            else:
+                replaceMap = myMapId if myMapId != None else myMapFile
+                plan.replaced.append(replaceMap)
+                plan.conflicting.append(m)
+                plan.addDownload(m, plan.new)
+        return plan
+
+    def verifyMaps(self):
+        cntChecked = 0
+        cntFiltered = 0
+        checks = []
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers = Config.settings['workerThreads'])
+        try:
+            for m in self.maps:
+                if not Filter.apply(m):
+                    cntFiltered = cntFiltered + 1
+                    continue
+                checks.append((m, pool.submit(MapArchiveInspector.checkArchive, self.GetMapPath(m))))
+                cntChecked = cntChecked + 1
+            cntCorrupt = self.collectChecks(checks)
+        finally:
+            pool.shutdown()
+        Info('VERIFY: ' + str(cntChecked - cntCorrupt) + ' ok, ' + str(cntCorrupt) + ' corrupted, ' + str(cntFiltered) + ' filtered')
+        Metrics.set('olmappy_verify_maps', cntChecked - cntCorrupt, {'result': 'ok'}, 'maps checked by VERIFY in this run')
+        Metrics.set('olmappy_verify_maps', cntCorrupt, {'result': 'corrupted'})
+
+    @Profiled('scan directory')
     def getUnindexedFiles(self, d, hidden = 0):
         files = []
         cntAlready = 0
         cntFail = 0
+        known = set()
+        for m in self.maps:
+            known.add(fileNameKey(self.GetMapFilenameAs(m, hidden=(hidden > 0))))
         try:
             for fname in os.listdir(d):
                 fullname = d + fname
@@ -654,44 +1873,58 @@ class localMapManager(MapManager):
                     if equalFileNames(fname, self.indexName):
                         continue
                     if stat.S_ISREG(os.lstat(fullname).st_mode):
-                        if hidden > 0:
-                            m = self.findMapByHiddenFileName(fname)
-                        else:
-                            m = self.findMapByFileName(fname)
-                        if m == None:
-                            Debug('file "' + fullname + '" not in index')
+                        if fileNameKey(fname) not in known:
+                            Debug('file "%s" not in index', fullname)
                             files = files + [fname]
                         else:
-                            Debug('file "' + fullname + '" already in index')
+                            Debug('file "%s" already in index', fullname)
                             cntAlready = cntAlready + 1
                     else:
-                        Debug('ignoring non-file "' + fullname + '"')
+                        Debug('ignoring non-file "%s"', fullname)
                 except Exception as E:
-                    Warn('failed to classify "'+fullname+'": ' + str(E))
+                    Warn('failed to classify "%s": %s', fullname, E)
                     cntFail = cntFail + 1
         except Exception as E:
             Warn('failed to scan directory "'+d+'": ' + str(E))
         return files, cntAlready, cntFail
 
-    def importDirFromRemote(self, d, remote, hidden=0):
+    def importDirFromRemote(self, d, remote, hidden=0, policy=None, bySize=None, offline=False):
+        # the remote map list is fetched once by importFromRemote, with
+        # offline set if that failed
         cntImp = 0
         cntIgn = 0
         cntReplace = 0
-        remote.update()
-        if not remote.valid:
-            Warn('IMPORT: failed due to not having a valid remote map list')
-            return
-
         files, cntAlready, cntFail = self.getUnindexedFiles(d, hidden)
         for fname in files:
             fullname = d + fname
+            renamed = False
             try:
-                Debug('IMPORT: file "' + fullname + '" not yet known')
-                if hidden>0:
-                    fname2 = self.RemoveFilenameDecoration(fname)
+                Debug('IMPORT: file "%s" not yet known', fullname)
+                if offline:
+                    newMap = self.getOfflineMap(d, fname, hidden)
+                    if newMap == None:
+                        Info('IMPORT: file "' + fullname + '" is not a map archive, ignoring')
+                        cntIgn = cntIgn + 1
+                        continue
+                    if self.findMapByFileName(newMap['filename']) != None:
+                        Info('IMPORT: file "' + fullname + '" is already indexed under another name, ignoring')
+                        cntIgn = cntIgn + 1
+                        continue
+                    if hidden > 0:
+                        self.RenameMap(fullname, self.GetMapPathAs(newMap, hidden=True))
                 else:
-                    fname2 = fname
-                newMap = remote.findMapByFileName(fname2)
+                    if hidden>0:
+                        fname2 = self.RemoveFilenameDecoration(fname)
+                    else:
+                        fname2 = fname
+                    newMap = remote.findMapByFileName(fname2)
+                    if newMap == None:
+                        newMap = self.findRenamedMap(fullname, bySize)
+                        renamed = (newMap != None)
+                    if newMap != None and policy != None and not policy.allows(newMap):
+                        Info('IMPORT: file "' + fullname + '" is excluded by the sync policy, ignoring')
+                        cntIgn = cntIgn + 1
+                        continue
                 if newMap != None:
                     if Filter.apply(newMap) == None:
                         newMap = None
@@ -713,8 +1946,16 @@ class localMapManager(MapManager):
                         cntIgn = cntIgn + 1
                 else:
                     newMap['hidden'] = hidden
+                    if renamed:
+                        target = self.GetMapPath(newMap)
+                        if os.path.exists(target):
+                            Info('IMPORT: file "' + fullname + '" is map ' + mapName(newMap) + ', but "' + target + '" already exists, ignoring')
+                            cntIgn = cntIgn + 1
+                            continue
+                        Info('IMPORT: file "' + fullname + '" identified as map ' + mapName(newMap) + ', renaming it')
+                        self.RenameMap(fullname, target)
                     if self.validateMap(newMap):
-                        self.maps = self.maps + [newMap]
+                        self.addMap(newMap)
                         cntImp = cntImp + 1
                         Info('IMPORT: file "' + fullname + '" imported')
                     else:
@@ -733,26 +1974,112 @@ class localMapManager(MapManager):
         cntIgn = 0
         cntReplace = 0
         cntFail = 0
-        a,b,c,d,e = self.importDirFromRemote(self.mapDir, remote)
-        cntAlready = cntAlready + a
-        cntImp = cntImp + b
-        cntIgn = cntIgn + c
-        cntReplace = cntReplace + d
-        cntFail = cntFail + e
-        a,b,c,d,e = self.importDirFromRemote(self.mapDir + self.hiddenDir, remote, 1)
-        cntAlready = cntAlready + a
-        cntImp = cntImp + b
-        cntIgn = cntIgn + c
-        cntReplace = cntReplace + d
-        cntFail = cntFail + e
+        policy = None
+        bySize = None
+        dirs = [(self.mapDir, 0), (self.mapDir + self.hiddenDir, 1)]
+        offline = not remote.update()
+        if not offline:
+            policy = SyncPolicy().select(remote.maps, self.maps)
+            if Config.settings['renameImport']:
+                bySize = self.getSizeIndex(remote)
+        elif not Config.settings['offlineImport']:
+            Warn('IMPORT: failed due to not having a valid remote map list')
+            dirs = []
+        else:
+            Warn('IMPORT: no valid remote map list, importing from the local map archives')
+        for mapDir, hidden in dirs:
+            a,b,c,d,e = self.importDirFromRemote(mapDir, remote, hidden, policy, bySize, offline)
+            cntAlready = cntAlready + a
+            cntImp = cntImp + b
+            cntIgn = cntIgn + c
+            cntReplace = cntReplace + d
+            cntFail = cntFail + e
+        self.saveArchiveCache()
         Info('IMPORT: ' + str(cntImp) + ' imported, ' + str(cntAlready) + ' already indexed, ' + str(cntIgn) + ' ignored, ' + str(cntReplace) + ' replaced, ' + str(cntFail) + ' failed to import')
-
-    def hideMap(self, m, doHide = True):
-        src = self.GetMapPath(m)
-        dst = self.GetMapPathAs(m, hidden=doHide)
-        if src != dst:
-            self.RenameMap(src, dst)
-        m['hidden'] = 1 if doHide else 0
+        for result, cnt in [('imported', cntImp), ('already', cntAlready), ('ignored', cntIgn), ('replaced', cntReplace), ('failed', cntFail)]:
+            Metrics.set('olmappy_import_files', cnt, {'result': result}, 'files handled by IMPORT in this run')
+
+    def getIntentLogFileName(self):
+        return self.mapDir + self.cacheDir + 'intent.json'
+
+    def writeIntentLog(self, ops):
+        filename = self.getIntentLogFileName()
+        f = open(file = filename + '.tmp', mode = 'wt', encoding = 'utf-8')
+        json.dump(ops, f)
+        Background.io(f.tell())
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.replace(filename + '.tmp', filename)
+
+    def recoverIntentLog(self):
+        # roll forward an interrupted change of the hidden states
+        filename = self.getIntentLogFileName()
+        try:
+            f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+            ops = json.load(f)
+            f.close()
+        except FileNotFoundError:
+            return
+        except Exception as E:
+            Warn('intent log ' + filename + ' could not be read, ignoring it: ' + str(E))
+            os.remove(filename)
+            return
+        Warn('found an unfinished change of the hidden state of ' + str(len(ops)) + ' maps, completing it')
+        byId = {}
+        for m in self.maps:
+            byId[m['id']] = m
+        for op in ops:
+            if os.path.lexists(op['src']) and not os.path.lexists(op['dst']):
+                try:
+                    self.RenameMap(op['src'], op['dst'])
+                except Exception:
+                    continue
+            elif not os.path.lexists(op['dst']):
+                Warn('neither "' + op['src'] + '" nor "' + op['dst'] + '" exist')
+                continue
+            m = byId.get(op['id'])
+            if m != None:
+                m['hidden'] = op['hidden']
+        if self.saveMapList():
+            os.remove(filename)
+
+    @Profiled('change hidden states')
+    def applyHiddenStates(self, changes, name):
+        # changes is a list of (map, hidden) tuples: all renames are planned
+        # and checked for collisions first, recorded in the intent log, and
+        # the index is committed once at the end
+        ops = []
+        opMaps = []
+        targets = set()
+        done = []
+        failed = []
+        for m, hidden in changes:
+            src = self.GetMapPath(m)
+            dst = self.GetMapPathAs(m, hidden=(hidden > 0))
+            if src != dst and (dst in targets or os.path.lexists(dst)):
+                Warn(name + ': map ' + mapName(m) + ' can not be renamed, "' + dst + '" already exists')
+                failed.append(m)
+                continue
+            targets.add(dst)
+            ops.append({'id': m['id'], 'src': src, 'dst': dst, 'hidden': hidden})
+            opMaps.append(m)
+        if len(ops) > 0:
+            self.writeIntentLog(ops)
+        batchSize = 256
+        for start in range(0, len(ops), batchSize):
+            for op, m in zip(ops[start:start + batchSize], opMaps[start:start + batchSize]):
+                try:
+                    if op['src'] != op['dst']:
+                        self.RenameMap(op['src'], op['dst'])
+                    m['hidden'] = op['hidden']
+                    done.append(m)
+                except Exception:
+                    failed.append(m)
+            Debug(name + ': renamed ' + str(min(start + batchSize, len(ops))) + ' of ' + str(len(ops)) + ' maps')
+        if self.saveMapList() and len(ops) > 0:
+            os.remove(self.getIntentLogFileName())
+        return done, failed
 
     def hideMaps(self, doHide = True):
         name = 'HIDE' if doHide else 'UNHIDE'
@@ -761,66 +2088,78 @@ class localMapManager(MapManager):
         cntAlready = 0
         cntIgn = 0
         cntFail = 0
+        changes = []
         if Filter.isEmpty():
             raise OlmappyParseError(name + ': no filter specified, use --all to apply to all')
-        for m in self.maps:
+        candidates = self.getFilterCandidates()
+        cntIgn = len(self.maps) - len(candidates)
+        for m in candidates:
             if not Filter.apply(m):
                 cntIgn = cntIgn + 1
                 continue
             if (m['hidden'] > 0) == doHide:
-                Debug(name + ': map ' + mapName(m) + ' is already ' + state)
+                Debug('%s: map %s is already %s', name, LazyMapName(m), state)
                 cntAlready = cntAlready + 1
                 continue
-            try:
-                self.hideMap(m, doHide)
-                Info(name + ': map ' + mapName(m) + ' is now ' + state)
-                cntHidden = cntHidden + 1
-            except Exception as E:
-                Warn(name + ': map ' + mapName(m) + ' failed to ' +name.lower() + ': ' + str(E))
-                cntFail = cntFail + 1
+            changes.append((m, 1 if doHide else 0))
+        done, failed = self.applyHiddenStates(changes, name)
+        for m in done:
+            Info(name + ': map ' + mapName(m) + ' is now ' + state)
+        cntHidden = len(done)
+        cntFail = len(failed)
         Info(name + ': ' + str(cntHidden) + ' ' + state.lower()+ ', ' + str(cntAlready) + ' already ' + state.lower() + ', ' + str(cntIgn) + ' unchanged, ' + str(cntFail) + ' failed to ' +name.lower())
 
-    def hideImportMaps(self, hideMaps):
-        cntFiltered = 0
-        cntInvalid = 0
-        cntNotPresent = 0
-        cntKept = 0
-        cntHidden = 0
-        cntUnhidden = 0
-        cntFail = 0
+    def getImportLookup(self):
+        byURL = {}
+        byId = {}
+        byName = {}
+        for m in self.maps:
+            byURL.setdefault(m['url'], m)
+            byId.setdefault(m['id'], m)
+            byName.setdefault(fileNameKey(m['filename']), m)
+        return byURL, byId, byName
+
+    def hideImportBatch(self, hideMaps, lookup, counts, changes):
+        # collects the imported hidden states in changes, by the local map;
+        # a later entry for the same map wins
+        byURL, byId, byName = lookup
         for m in hideMaps:
+            if not isinstance(m, dict):
+                Warn('HIDEIMPORT: entry %s is not a map, ignored as invalid', m)
+                counts['invalid'] = counts['invalid'] + 1
+                continue
             if not Filter.apply(m):
-                cntFiltered = cntFiltered + 1
+                counts['filtered'] = counts['filtered'] + 1
                 continue
             myMap = None
             if 'url' in m:
-                myMap = self.findMapByURL(m['url'])
+                myMap = byURL.get(m['url'])
             elif 'id' in m:
-                myMap = self.findMapById(m['id'])
+                myMap = byId.get(m['id'])
             elif 'filename' in m:
-                myMap = self.findMapByFileName(m['filename'])
+                myMap = byName.get(fileNameKey(m['filename']))
             else:
-                Warn('HIDEIMPORT: map ' + str(m) + 'lacks a proper identification, ignored as invalid')
-                cntInvalid = cntInvalid + 1
+                Warn('HIDEIMPORT: map %s lacks a proper identification, ignored as invalid', m)
+                counts['invalid'] = counts['invalid'] + 1
                 continue
             if myMap == None:
-                Debug('HIDEIMPORT: map ' + mapName(m) + ' is not locally available, ignored')
-                cntNotPresent = cntNotPresent + 1
+                Debug('HIDEIMPORT: map %s is not locally available, ignored', LazyMapName(m))
+                counts['notPresent'] = counts['notPresent'] + 1
                 continue
             if 'size' in m:
                 if myMap['size'] != m ['size']:
-                    Warn('HIDEIMPORT: map ' + mapName(m) + ' has different size than ours, ignored as invalid')
-                    cntInvalid = cntInvalid + 1
+                    Warn('HIDEIMPORT: map %s has different size than ours, ignored as invalid', LazyMapName(m))
+                    counts['invalid'] = counts['invalid'] + 1
                     continue
             if 'mtime' in m:
                 if myMap['mtime'] != m ['mtime']:
-                    Warn('HIDEIMPORT: map ' + mapName(m) + ' has different mtime than ours, ignored as invalid')
-                    cntInvalid = cntInvalid + 1
+                    Warn('HIDEIMPORT: map %s has different mtime than ours, ignored as invalid', LazyMapName(m))
+                    counts['invalid'] = counts['invalid'] + 1
                     continue
 
             if 'hidden' not in m:
-                Warn('HIDEIMPORT: map ' + mapName(m) + ' has no hidden state to import, ignored as invalid')
-                cntInvalid = cntInvalid + 1
+                Warn('HIDEIMPORT: map %s has no hidden state to import, ignored as invalid', LazyMapName(m))
+                counts['invalid'] = counts['invalid'] + 1
                 continue
             if m['hidden'] > 0:
                 m['hidden'] = 1
@@ -828,28 +2167,166 @@ class localMapManager(MapManager):
                 m['hidden'] = 0
             if Cmd.args.reverse == True:
                 m['hidden'] = 1 - m['hidden']
+            changes[id(myMap)] = (myMap, m['hidden'])
+
+    def hideImportApply(self, changes, counts):
+        # all renames are recorded in one intent log and the index is
+        # committed once
+        toChange = []
+        for myMap, hidden in changes.values():
+            if hidden == myMap['hidden']:
+                Debug('HIDEIMPORT: map %s kept as %s', LazyMapName(myMap), 'HIDDEN' if hidden > 0 else 'UNHIDDEN')
+                counts['kept'] = counts['kept'] + 1
+            else:
+                toChange.append((myMap, hidden))
+        if len(toChange) < 1:
+            return
+        done, failed = self.applyHiddenStates(toChange, 'HIDEIMPORT')
+        for m in done:
             if m['hidden'] > 0:
-                state = 'HIDDEN'
+                Info('HIDEIMPORT: map ' + mapName(m) + ' is now HIDDEN')
+                counts['hidden'] = counts['hidden'] + 1
             else:
-                state = 'UNHIDDEN'
-            if m['hidden'] == myMap['hidden']:
-                Debug('HIDEIMPORT: map ' + mapName(m) + ' kept as ' + state)
-                cntKept = cntKept + 1
+                Info('HIDEIMPORT: map ' + mapName(m) + ' is now UNHIDDEN')
+                counts['unhidden'] = counts['unhidden'] + 1
+        counts['failed'] = counts['failed'] + len(failed)
+
+    def hideImportMaps(self, hideMaps):
+        counts = dict.fromkeys(['hidden', 'unhidden', 'kept', 'notPresent', 'filtered', 'invalid', 'failed'], 0)
+        changes = {}
+        self.hideImportBatch(hideMaps, self.getImportLookup(), counts, changes)
+        self.hideImportApply(changes, counts)
+        self.showImportCounts(counts)
+
+    @staticmethod
+    def showImportCounts(counts):
+        Info('HIDEIMPORT: ' + str(counts['hidden']) + ' hidden, ' + str(counts['unhidden']) + ' unhidden, ' + str(counts['kept']) + ' unchanged, ' + str(counts['notPresent']) + ' not present, ' + str(counts['filtered']) + ' filtered, ' + str(counts['invalid']) + ' invalid, ' + str(counts['failed']) + ' failed to change')
+
+    @staticmethod
+    def isNDJSONFile(filename):
+        # a json map list starts with '[', ndjson with one object per line
+        f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+        try:
+            while True:
+                c = f.read(1)
+                if c == '' or not c.isspace():
+                    return c == '{'
+        finally:
+            f.close()
+
+    def hideImportStream(self, filename):
+        # the file is read and checked in batches, so memory use only depends
+        # on the number of local maps, not on the size of the file; the
+        # changes are applied at the end in one transaction
+        batchSize = Config.settings['importBatchSize']
+        counts = dict.fromkeys(['hidden', 'unhidden', 'kept', 'notPresent', 'filtered', 'invalid', 'failed'], 0)
+        lookup = self.getImportLookup()
+        changes = {}
+        cntLines = 0
+        batch = []
+        f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+        try:
+            for line in f:
+                cntLines = cntLines + 1
+                line = line.strip()
+                if len(line) < 1:
+                    continue
+                try:
+                    m = json.loads(line)
+                except Exception as E:
+                    Warn('HIDEIMPORT: line %d of "%s" could not be parsed, ignored as invalid: %s', cntLines, filename, E)
+                    counts['invalid'] = counts['invalid'] + 1
+                    continue
+                if not isinstance(m, dict):
+                    Warn('HIDEIMPORT: line %d of "%s" is not a map, ignored as invalid', cntLines, filename)
+                    counts['invalid'] = counts['invalid'] + 1
+                    continue
+                batch.append(m)
+                if len(batch) >= batchSize:
+                    self.hideImportBatch(batch, lookup, counts, changes)
+                    batch = []
+                    Info('HIDEIMPORT: ' + str(cntLines) + ' lines of "' + filename + '" processed')
+            self.hideImportBatch(batch, lookup, counts, changes)
+        finally:
+            f.close()
+        self.hideImportApply(changes, counts)
+        self.showImportCounts(counts)
+
+    def exportManifest(self, filename, peerFile, withEntries):
+        manifest = HiddenManifest.fromMaps(self.maps)
+        peer = HiddenManifest.load(peerFile) if peerFile != None else None
+        cnt = manifest.write(filename, peer, withEntries)
+        Info('EXPORTMANIFEST: ' + str(len(self.maps)) + ' maps, ' + str(manifest.countHidden()) + ' hidden, ' + str(cnt) + ' chunks with entries written to "' + filename + '"')
+
+    def syncHidden(self, filename):
+        peer = HiddenManifest.load(filename)
+        manifest = HiddenManifest.fromMaps(self.maps)
+        digests = manifest.getDigests()
+        if peer['digest'] == manifest.combinedDigest(digests):
+            Info('HIDESYNC: hidden state is already in sync with "' + filename + '"')
+            return
+        byChunk = {}
+        for m in self.maps:
+            byChunk.setdefault(HiddenManifest.chunkOf(m['url']), []).append(m)
+        changes = []
+        cntDiffer = 0
+        cntMissing = 0
+        cntInvalid = 0
+        cntUnknown = 0
+        cntUnconfirmed = 0
+        for i, d in enumerate(digests):
+            if peer['chunks'][i] == d:
                 continue
-            try:
-                if m['hidden'] == 0:
-                    self.hideMap(myMap, False)
-                    cntUnhidden = cntUnhidden + 1
-                else:
-                    self.hideMap(myMap, True)
-                    cntHidden = cntHidden + 1
-                Info('HIDEIMPORT: map ' + mapName(myMap) + ' is now ' + state)
-            except Exception as E:
-                Warn(name + ': map ' + mapName(m) + ' failed to set to ' +state + ': ' + str(E))
-                cntFail = cntFail + 1
-        Info('HIDEIMPORT: ' + str(cntHidden) + ' hidden, ' + str(cntUnhidden) + ' unhidden, ' + str(cntKept) + ' unchanged, ' + str(cntNotPresent) + ' not present, ' + str(cntFiltered) + ' filtered, ' + str(cntInvalid) + ' invalid, ' + str(cntFail) + ' failed to change')
+            cntDiffer = cntDiffer + 1
+            entries = peer['entries'].get(str(i), [] if peer['complete'] else None)
+            if entries == None:
+                cntMissing = cntMissing + 1
+                continue
+            known = {}
+            for e in entries:
+                known[e['url']] = e
+            for m in byChunk.get(i, []):
+                if not Filter.apply(m):
+                    continue
+                e = known.get(m['url'])
+                if e == None:
+                    if not peer['complete']:
+                        # the peer does not have this map, so it has no state for it
+                        cntUnknown = cntUnknown + 1
+                    elif m['hidden'] > 0:
+                        # a complete manifest only lists the hidden maps, so
+                        # the peer either shows this map or does not know it
+                        cntUnconfirmed = cntUnconfirmed + 1
+                    continue
+                if e['mtime'] != m['mtime'] or e['size'] != m['size']:
+                    Warn('HIDESYNC: map %s has a different mtime or size than ours, ignored as invalid', LazyMapName(m))
+                    cntInvalid = cntInvalid + 1
+                    continue
+                state = 1 if e['hidden'] > 0 else 0
+                if (m['hidden'] > 0) != (state > 0):
+                    changes.append((m, state))
+        if cntMissing > 0:
+            Warn('HIDESYNC: ' + str(cntMissing) + ' differing chunks are not included in "' + filename + '", export it with --peer-manifest')
+        if cntUnconfirmed > 0:
+            Warn('HIDESYNC: ' + str(cntUnconfirmed) + ' hidden maps are not hidden in "' + filename + '" and left hidden, export it with --peer-manifest to unhide maps')
+        if len(changes) < 1:
+            # the chunks only differ in maps which are not on both hosts
+            Info('HIDESYNC: no hidden state to change, ' + str(cntUnknown) + ' maps unknown to "' + filename + '", ' + str(cntUnconfirmed) + ' left hidden, ' + str(cntInvalid) + ' invalid')
+            return
+        done, failed = self.applyHiddenStates(changes, 'HIDESYNC')
+        for m in done:
+            Info('HIDESYNC: map ' + mapName(m) + ' is now ' + ('HIDDEN' if m['hidden'] > 0 else 'UNHIDDEN'))
+        Info('HIDESYNC: ' + str(cntDiffer) + ' of ' + str(len(digests)) + ' chunks differ, ' + str(len(done)) + ' maps changed, ' + str(cntUnknown) + ' unknown to the peer, ' + str(cntUnconfirmed) + ' left hidden, ' + str(cntInvalid) + ' invalid, ' + str(len(failed)) + ' failed to change')
 
     def hideImport(self, filename):
+        fmt = Cmd.args.format[0] if Cmd.args.format != None else None
+        try:
+            stream = (fmt == 'ndjson') or (fmt == None and self.isNDJSONFile(filename))
+        except Exception as E:
+            stream = False
+        if stream:
+            self.hideImportStream(filename)
+            return
         hideMaps, valid = self.loadMapListFile(filename)
         if len(hideMaps) > 0 and valid:
             self.hideImportMaps(hideMaps)
@@ -858,10 +2335,657 @@ class localMapManager(MapManager):
 
     def listIgnored(self):
         files, cntAlready, cntFail = self.getUnindexedFiles(self.mapDir)
+        archives = self.getArchiveInspector()
         for fname in files:
-            print('"' + fname + '"')
+            try:
+                entry = archives.inspect(self.mapDir + fname, fname)
+                print('"' + fname + '": ' + archives.levelsDesc(entry['levels']))
+            except Exception as E:
+                print('"' + fname + '": (failed to inspect: ' + str(E) + ')')
+        self.saveArchiveCache()
         Debug('LISTIGNORED: ' + str(len(files)) + ' ignored, ' + str(cntAlready) + ' indexed, ' + str(cntFail) + ' failed')
 
+##############################################################################
+# class for synchronization plans                                            #
+##############################################################################
+
+class SyncPlan:
+    def __init__(self):
+        self.new = []
+        self.updated = []
+        self.conflicting = []
+        self.adopted = []
+        self.replaced = []
+        self.importable = []
+        self.unknown = []
+        self.excluded = []
+        self.excludedFiles = []
+        self.actions = []
+        self.cntUnchanged = 0
+        self.cntUnknownSize = 0
+        self.downloadSize = 0
+
+    def addDownload(self, m, category):
+        category.append(m)
+        self.actions.append(m)
+        if m['size'] > 0:
+            self.downloadSize = self.downloadSize + m['size']
+        else:
+            self.cntUnknownSize = self.cntUnknownSize + 1
+
+    def show(self):
+        for m in self.new:
+            print('NEW:         ' + mapDesc(m))
+        for m in self.updated:
+            print('UPDATED:     ' + mapDesc(m))
+        for m in self.conflicting:
+            print('CONFLICTING: ' + mapDesc(m))
+        for m in self.adopted:
+            print('ADOPTED:     ' + mapDesc(m))
+        for m in self.replaced:
+            print('REPLACED:    ' + mapDesc(m))
+        for f in self.importable:
+            print('IMPORT:      "' + f + '"')
+        unknownState = 'REPLACED:    ' if Config.settings['removeUnknownMaps'] else 'UNKNOWN:     '
+        for f in self.unknown:
+            print(unknownState + '"' + f + '"')
+        for m in self.excluded:
+            print('EXCLUDED:    ' + mapDesc(m))
+        for f in self.excludedFiles:
+            print('EXCLUDED:    "' + f + '"')
+        text = 'PLAN: ' + str(len(self.new) - len(self.conflicting)) + ' new, ' + str(len(self.updated)) + ' updated, ' + str(len(self.conflicting)) + ' conflicting, ' + str(len(self.adopted)) + ' adopted, ' + str(self.cntUnchanged) + ' unchanged, ' + str(len(self.replaced)) + ' to be replaced, ' + str(len(self.importable)) + ' to be imported, ' + str(len(self.unknown)) + ' unknown, ' + str(len(self.excluded) + len(self.excludedFiles)) + ' excluded by the sync policy'
+        text = text + '; ' + str(self.downloadSize) + ' bytes to download'
+        if self.cntUnknownSize > 0:
+            text = text + ' plus ' + str(self.cntUnknownSize) + ' maps of unknown size'
+        Info(text)
+
+##############################################################################
+# class for the sync policy                                                  #
+##############################################################################
+
+class SyncPolicy:
+    # decides which maps of the remote map list are synchronized, based on
+    # the sync* settings; the remote list is selected once per operation
+    def __init__(self):
+        self.types = 0
+        for t in Config.settings['syncTypes'].split(','):
+            t = t.strip()
+            if len(t) > 0:
+                self.types = self.types | MapType.MapTypeString(t)
+        self.maxAge = Config.settings['syncMaxAge'] * 86400
+        self.maxMapSize = Config.settings['syncMaxMapSize'] * 1024 * 1024
+        self.diskBudget = Config.settings['syncDiskBudget'] * 1024 * 1024
+        self.keepOrder = Config.settings['syncKeepOrder']
+        self.allowed = None
+
+    def isEmpty(self):
+        return self.types == 0 and self.maxAge <= 0 and self.maxMapSize <= 0 and self.diskBudget <= 0
+
+    def accepts(self, m, minTime):
+        if self.types != 0 and (m['types'] & self.types) == 0:
+            return False
+        if self.maxAge > 0 and m['mtime'] < minTime:
+            return False
+        if self.maxMapSize > 0 and m['size'] > self.maxMapSize:
+            return False
+        return True
+
+    def select(self, maps, localMaps = None):
+        # localMaps are the maps on disk: the ones which are no longer on the
+        # server or excluded by the policy stay there and use up a part of
+        # the disk budget, and their sizes stand in for remote maps of
+        # unknown size
+        if self.isEmpty():
+            self.allowed = None
+            return self
+        minTime = time.time() - self.maxAge
+        selected = [m for m in maps if self.accepts(m, minTime)]
+        if self.diskBudget > 0:
+            selectedIds = set(m['id'] for m in selected)
+            localSizes = {}
+            used = 0
+            for m in localMaps or []:
+                if m['size'] <= 0:
+                    continue
+                if m['id'] in selectedIds:
+                    localSizes[m['id']] = m['size']
+                else:
+                    used = used + m['size']
+            if used > 0:
+                Debug('sync policy: %d bytes of the disk budget used by local maps which are kept', used)
+            # keep the maps in the configured order until the budget is used
+            # up, a map of unknown size can't be accounted for and is only
+            # kept if there is a local copy to take the size from
+            kept = []
+            cntUnknownSize = 0
+            for m in MapManager.sortMaps(selected, self.keepOrder):
+                size = m['size'] if m['size'] >= 0 else localSizes.get(m['id'], -1)
+                if size < 0:
+                    cntUnknownSize = cntUnknownSize + 1
+                    continue
+                if used + size <= self.diskBudget:
+                    used = used + size
+                    kept.append(m)
+            if cntUnknownSize > 0:
+                Info('sync policy: %d maps of unknown size excluded by the disk budget', cntUnknownSize)
+            selected = kept
+        self.allowed = set(m['id'] for m in selected)
+        Debug('sync policy: %d of %d remote maps selected', len(self.allowed), len(maps))
+        return self
+
+    def allows(self, m):
+        return self.allowed == None or m['id'] in self.allowed
+
+##############################################################################
+# class for the hidden state manifest                                        #
+##############################################################################
+
+class HiddenManifest:
+    # The maps known to a host are split into chunks by a hash of the map URL.
+    # Each chunk has a digest over its hidden maps, and the manifest has a
+    # digest over the chunk digests, so two hosts can compare their hidden
+    # states in one step, and then only need to exchange the chunks which
+    # differ. A complete manifest only lists the hidden maps; the differing
+    # chunks exported for a peer list every map with its hidden state, so a
+    # map the peer does not know is left alone.
+    version = 3
+    numChunks = 256
+
+    def __init__(self):
+        self.chunks = [{} for i in range(self.numChunks)]
+
+    @classmethod
+    def chunkOf(cls, url):
+        return int(hashlib.sha1(url.encode('utf-8')).hexdigest()[0:4], 16) % cls.numChunks
+
+    @staticmethod
+    def entry(m):
+        return {'url': m['url'], 'mtime': m['mtime'], 'size': m['size'], 'hidden': 1 if m['hidden'] > 0 else 0}
+
+    @classmethod
+    def fromMaps(cls, maps):
+        manifest = cls()
+        for m in maps:
+            manifest.chunks[cls.chunkOf(m['url'])][m['url']] = cls.entry(m)
+        return manifest
+
+    def countHidden(self):
+        return sum(1 for c in self.chunks for e in c.values() if e['hidden'] > 0)
+
+    @staticmethod
+    def chunkDigest(entries):
+        h = hashlib.sha1()
+        for url in sorted(entries):
+            e = entries[url]
+            if e['hidden'] > 0:
+                h.update((url + '\t' + str(e['mtime']) + '\t' + str(e['size']) + '\n').encode('utf-8'))
+        return h.hexdigest()
+
+    def getDigests(self):
+        return [self.chunkDigest(c) for c in self.chunks]
+
+    @staticmethod
+    def combinedDigest(digests):
+        return hashlib.sha1(''.join(digests).encode('utf-8')).hexdigest()
+
+    def write(self, filename, peer = None, withEntries = True):
+        # with a peer manifest, only the entries of differing chunks are written
+        digests = self.getDigests()
+        peerDigests = peer['chunks'] if peer != None else None
+        chunks = {}
+        for i, d in enumerate(digests):
+            if not withEntries:
+                break
+            if peerDigests != None:
+                if peerDigests[i] != d:
+                    chunks[str(i)] = list(self.chunks[i].values())
+                continue
+            hidden = [e for e in self.chunks[i].values() if e['hidden'] > 0]
+            if len(hidden) > 0:
+                chunks[str(i)] = hidden
+        # in a complete manifest, chunks without entries have no hidden maps
+        complete = withEntries and peer == None
+        data = {'version': self.version, 'digest': self.combinedDigest(digests), 'complete': complete, 'chunks': digests, 'entries': chunks}
+        f = open(file = filename + '.tmp', mode = 'wt', encoding = 'utf-8')
+        json.dump(data, f, indent=1)
+        Background.io(f.tell())
+        f.close()
+        os.replace(filename + '.tmp', filename)
+        return len(chunks)
+
+    @classmethod
+    def load(cls, filename):
+        f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+        data = json.load(f)
+        f.close()
+        if data.get('version') != cls.version or len(data.get('chunks', [])) != cls.numChunks:
+            raise OlmappyParseError('"' + filename + '" is not a hidden state manifest of version ' + str(cls.version))
+        return data
+
+##############################################################################
+# class for the history of the remote map list                               #
+##############################################################################
+
+class RemoteHistory:
+    # every line of the history file is one JSON record: the keys removed
+    # and the (raw) entries added since the previous record, a full
+    # checkpoint of the list is written every checkpointInterval records.
+    # Entries are keyed by ID, mtime and size, so a map which is changed on
+    # the server is recorded as removal of the old and addition of the new
+    # version. The keys of the last recorded list are kept in a state file,
+    # so recording does not need to replay the history, and the history is
+    # compacted to the records since the previous checkpoint at every new one.
+    version = 2
+    checkpointInterval = 100
+    rawKeys = ['url', 'mtime', 'size', 'levels']
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.stateFilename = os.path.splitext(filename)[0] + '.state.json'
+
+    def readRecords(self):
+        records = []
+        try:
+            f = open(file = self.filename, mode = 'rt', encoding = 'utf-8')
+            try:
+                for line in f:
+                    if len(line.strip()) > 0:
+                        r = json.loads(line)
+                        # records of older versions are superseded by the
+                        # first checkpoint of the current one
+                        if r.get('v') == self.version:
+                            records.append(r)
+            finally:
+                f.close()
+        except FileNotFoundError:
+            pass
+        except Exception as E:
+            Warn('remote history ' + self.filename + ' could not be read: ' + str(E))
+        return records
+
+    def readState(self):
+        try:
+            f = open(file = self.stateFilename, mode = 'rt', encoding = 'utf-8')
+            state = json.load(f)
+            f.close()
+            if state.get('v') == self.version:
+                return state
+        except FileNotFoundError:
+            pass
+        except Exception as E:
+            Warn('remote history state ' + self.stateFilename + ' could not be read: ' + str(E))
+        return None
+
+    def writeState(self, state):
+        f = open(file = self.stateFilename + '.tmp', mode = 'wt', encoding = 'utf-8')
+        json.dump(state, f, separators=(',', ':'))
+        Background.io(f.tell())
+        f.close()
+        os.replace(self.stateFilename + '.tmp', self.stateFilename)
+
+    def getLastTime(self):
+        state = self.readState()
+        return state['time'] if state != None else None
+
+    @classmethod
+    def rawEntry(cls, m):
+        raw = {}
+        for key in cls.rawKeys:
+            if key in m:
+                raw[key] = m[key]
+        return raw
+
+    @staticmethod
+    def entryKey(raw):
+        return raw['url'].split('/')[-2] + '\t' + str(raw.get('mtime')) + '\t' + str(raw.get('size'))
+
+    @classmethod
+    def applyRecord(cls, state, r):
+        if 'full' in r:
+            state.clear()
+        for k in r['del']:
+            state.pop(k, None)
+        for raw in r['add']:
+            state[cls.entryKey(raw)] = raw
+
+    def compact(self):
+        # keep only the records since the last checkpoint
+        records = self.readRecords()
+        last = 0
+        for i, r in enumerate(records):
+            if 'full' in r:
+                last = i
+        f = open(file = self.filename + '.tmp', mode = 'wt', encoding = 'utf-8')
+        for r in records[last:]:
+            f.write(json.dumps(r, separators=(',', ':')) + '\n')
+        Background.io(f.tell())
+        f.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def record(self, maps, timestamp):
+        state = self.readState()
+        current = {}
+        for m in maps:
+            current[self.entryKey(m)] = m
+        r = {'v': self.version, 'time': timestamp}
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            if state == None or state['count'] >= self.checkpointInterval:
+                if state != None:
+                    self.compact()
+                r['full'] = 1
+                r['del'] = []
+                r['add'] = [self.rawEntry(m) for m in maps]
+                cnt = 0
+            else:
+                keys = set(state['keys'])
+                r['del'] = [k for k in state['keys'] if k not in current]
+                r['add'] = [self.rawEntry(m) for k, m in current.items() if k not in keys]
+                cnt = state['count'] + 1
+            line = json.dumps(r, separators=(',', ':')) + '\n'
+            f = open(file = self.filename, mode = 'at', encoding = 'utf-8')
+            f.write(line)
+            Background.io(len(line))
+            f.close()
+            self.writeState({'v': self.version, 'time': timestamp, 'count': cnt, 'keys': list(current)})
+            Debug('recorded remote history ' + self.filename + ': ' + str(len(r['add'])) + ' added, ' + str(len(r['del'])) + ' removed')
+        except Exception as E:
+            Warn('remote history ' + self.filename + ' could not be written: ' + str(E))
+
+    def changesSince(self, since):
+        # returns the added and the removed raw entries, by key
+        state = {}
+        added = {}
+        removed = {}
+        haveBase = False
+        for r in self.readRecords():
+            if r['time'] < since or not haveBase:
+                self.applyRecord(state, r)
+                haveBase = True
+                continue
+            if 'full' in r:
+                keys = set()
+                for raw in r['add']:
+                    keys.add(self.entryKey(raw))
+                r = {'del': [k for k in state if k not in keys],
+                     'add': [raw for raw in r['add'] if self.entryKey(raw) not in state]}
+            for k in r['del']:
+                if k in added:
+                    del added[k]
+                elif k in state:
+                    removed[k] = state[k]
+            for raw in r['add']:
+                k = self.entryKey(raw)
+                if k in removed:
+                    del removed[k]
+                else:
+                    added[k] = raw
+            self.applyRecord(state, r)
+        return added, removed
+
+##############################################################################
+# class for bandwidth limiting                                               #
+##############################################################################
+
+class TokenBucket:
+    def __init__(self, rate):
+        # rate in bytes per second, 0 means unlimited
+        self.rate = rate
+        self.capacity = max(rate, 64*1024)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens = self.tokens - amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+##############################################################################
+# class for running maintenance in the background                            #
+##############################################################################
+
+class BackgroundMode:
+    # ioprio_set is not wrapped by the C library, so it is called by its
+    # system call number, which depends on the architecture
+    ioprioSyscalls = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30,
+                      'armv7l': 314, 'armv6l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282, 'riscv64': 30}
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASS_IDLE = 3
+    IOPRIO_CLASS_SHIFT = 13
+    # number of renames and file checks between two pauses
+    batchSize = 16
+
+    def __init__(self):
+        self.enabled = False
+        self.disk = TokenBucket(0)
+        self.pause = 0.0
+        self.cnt = 0
+        self.lock = threading.Lock()
+
+    def enable(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            return
+        self.disk = TokenBucket(Config.settings['backgroundDiskRate'] * 1024)
+        self.pause = Config.settings['backgroundPause'] / 1000.0
+        cpu = self.lowerCPUPriority()
+        io = self.lowerIOPriority()
+        Debug('background mode: CPU priority %s, I/O priority %s, disk rate %d KiB/s', cpu, io, Config.settings['backgroundDiskRate'])
+
+    @staticmethod
+    def lowerCPUPriority():
+        # returns a description of what could be done
+        result = 'unchanged'
+        try:
+            os.nice(19)
+            result = 'nice 19'
+        except (AttributeError, OSError) as E:
+            Debug('background mode: could not lower the CPU priority: %s', E)
+        if hasattr(os, 'sched_setscheduler') and hasattr(os, 'SCHED_IDLE'):
+            try:
+                os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+                result = 'idle'
+            except OSError as E:
+                Debug('background mode: could not set the idle scheduling policy: %s', E)
+        return result
+
+    @classmethod
+    def lowerIOPriority(cls):
+        if not sys.platform.startswith('linux'):
+            return 'unchanged'
+        nr = cls.ioprioSyscalls.get(platform.machine().lower())
+        if nr == None:
+            Debug('background mode: no ioprio_set system call known for %s', platform.machine())
+            return 'unchanged'
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.syscall(nr, cls.IOPRIO_WHO_PROCESS, 0, cls.IOPRIO_CLASS_IDLE << cls.IOPRIO_CLASS_SHIFT) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except Exception as E:
+            Debug('background mode: could not lower the I/O priority: %s', E)
+            return 'unchanged'
+        return 'idle'
+
+    def io(self, amount):
+        # pace disk reads and writes of amount bytes
+        if self.enabled:
+            self.disk.consume(amount)
+
+    def read(self, *filenames):
+        # pace reading the whole files
+        if not self.enabled:
+            return
+        for filename in filenames:
+            try:
+                self.disk.consume(os.stat(filename).st_size)
+            except OSError:
+                pass
+
+    def step(self):
+        # called after each rename or file check, pauses after every batch
+        if not self.enabled or self.pause <= 0:
+            return
+        with self.lock:
+            self.cnt = self.cnt + 1
+            pause = (self.cnt % self.batchSize) == 0
+        if pause:
+            time.sleep(self.pause)
+
+##############################################################################
+# classes for recording and replaying HTTP sessions                          #
+##############################################################################
+
+# A session archive is a directory with an index.json file, which has one
+# json record per response (written in the order the responses finished),
+# and a bodies/ sub-directory with the response bodies. Responses are keyed
+# by method, path and Range header, so an archive can be replayed against
+# any mapServer setting.
+
+def sessionKey(method, url, headers):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    rangeHeader = headers.get('Range', '') if headers != None else ''
+    return method + ' ' + path + ' ' + rangeHeader
+
+class RecordingResponse:
+    def __init__(self, transport, key, response, start):
+        self.transport = transport
+        self.key = key
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.start = start
+        self.latency = time.perf_counter() - start
+        self.recorded = False
+
+    @property
+    def data(self):
+        data = self.response.data
+        self.record([data], 0.0, None)
+        return data
+
+    def stream(self, amt = 64*1024):
+        chunks = []
+        start = time.perf_counter()
+        try:
+            for chunk in self.response.stream(amt):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as E:
+            self.record(chunks, time.perf_counter() - start, str(E))
+            raise
+        self.record(chunks, time.perf_counter() - start, None)
+
+    def release_conn(self):
+        self.response.release_conn()
+        self.record([], 0.0, None)
+
+    def record(self, chunks, duration, error):
+        if not self.recorded:
+            self.recorded = True
+            self.transport.record(self.key, self.status, self.latency, b''.join(chunks), duration, error)
+
+class RecordingTransport:
+    def __init__(self, http, directory):
+        self.http = http
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory + 'bodies/', exist_ok=True)
+        Info('recording HTTP session to "' + directory + '"')
+
+    def request(self, method, url, preload_content = True, headers = None):
+        key = sessionKey(method, url, headers)
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, url, preload_content = preload_content, headers = headers)
+        except Exception as E:
+            # failed requests are recorded with status 0
+            self.record(key, 0, time.perf_counter() - start, b'', 0.0, str(E))
+            raise
+        return RecordingResponse(self, key, response, start)
+
+    def record(self, key, status, latency, body, duration, error):
+        name = hashlib.sha1((key + ' ' + str(time.time_ns()) + ' ' + str(threading.get_ident())).encode('utf-8')).hexdigest()
+        entry = {'key': key, 'status': status, 'latency': latency, 'duration': duration, 'size': len(body), 'body': name, 'error': error}
+        with self.lock:
+            f = open(self.directory + 'bodies/' + name, 'wb')
+            f.write(body)
+            f.close()
+            f = open(file = self.directory + 'index.json', mode = 'at', encoding = 'utf-8')
+            f.write(json.dumps(entry) + '\n')
+            f.close()
+
+class ReplayResponse:
+    def __init__(self, transport, entry):
+        self.transport = transport
+        self.entry = entry
+        self.status = entry['status']
+        self.headers = {}
+
+    def getBody(self):
+        f = open(self.transport.directory + 'bodies/' + self.entry['body'], 'rb')
+        body = f.read()
+        f.close()
+        return body
+
+    @property
+    def data(self):
+        return self.getBody()
+
+    def stream(self, amt = 64*1024):
+        body = self.getBody()
+        chunkTime = self.entry['duration'] * amt / len(body) if len(body) > 0 else 0
+        for pos in range(0, len(body), amt):
+            self.transport.wait(min(chunkTime, self.entry['duration']))
+            yield body[pos:pos+amt]
+        if self.entry['error'] != None:
+            raise OlmappyTransferError('replayed error: ' + self.entry['error'])
+
+    def release_conn(self):
+        pass
+
+class ReplayTransport:
+    def __init__(self, directory, speed):
+        # speed 1 replays at the recorded speed, 0 as fast as possible
+        self.directory = directory
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.responses = {}
+        f = open(file = directory + 'index.json', mode = 'rt', encoding = 'utf-8')
+        for line in f:
+            if len(line.strip()) > 0:
+                entry = json.loads(line)
+                self.responses.setdefault(entry['key'], []).append(entry)
+        f.close()
+        Info('replaying HTTP session from "' + directory + '": ' + str(sum(len(r) for r in self.responses.values())) + ' responses')
+
+    def wait(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def request(self, method, url, preload_content = True, headers = None):
+        key = sessionKey(method, url, headers)
+        with self.lock:
+            recorded = self.responses.get(key)
+            if recorded == None:
+                raise OlmappyTransferError('no recorded response for ' + key)
+            # the responses for a key are replayed in order, the last one repeats
+            entry = recorded[0] if len(recorded) == 1 else recorded.pop(0)
+        self.wait(entry['latency'])
+        response = ReplayResponse(self, entry)
+        if entry['status'] == 0 or (preload_content and entry['error'] != None):
+            raise OlmappyTransferError('replayed error: ' + entry['error'])
+        return response
+
 ##############################################################################
 # class for managing the remote map server                                   #
 ##############################################################################
@@ -872,22 +2996,41 @@ class remoteMapManager(MapManager):
         self.name = 'remote'
         self.valid = False
         self.listURL = Config.settings['mapServer'] + Config.settings['mapServerListURL']
+        self.bandwidth = TokenBucket(Config.settings['maxDownloadRate'] * 1024)
+        if len(Config.settings['httpReplay']) > 0:
+            self.http = ReplayTransport(self.getSessionDir(Config.settings['httpReplay']), Config.settings['httpReplaySpeed'])
+            return
         certMode = 'CERT_REQUIRED' if Config.settings['verifyCertificates'] else 'CERT_NONE'
+        maxsize = Config.settings['maxConnections']
         if len(Config.settings['certificateBundle']) > 0:
-            self.http = urllib3.PoolManager(cert_reqs=certMode, ca_certs=Config.settings['certificateBundle'])
+            self.http = urllib3.PoolManager(cert_reqs=certMode, ca_certs=Config.settings['certificateBundle'], maxsize=maxsize)
         else:
-            self.http = urllib3.PoolManager(cert_reqs=certMode)
+            self.http = urllib3.PoolManager(cert_reqs=certMode, maxsize=maxsize)
+        if len(Config.settings['httpRecord']) > 0:
+            self.http = RecordingTransport(self.http, self.getSessionDir(Config.settings['httpRecord']))
+
+    @staticmethod
+    def getSessionDir(d):
+        return d if d[-1] == '/' else d + '/'
 
     def getMapList(self):
         url = self.listURL
         try:
-            request = self.http.request('GET', url)
+            start = time.perf_counter()
+            with Profile.phase('fetch remote list'):
+                request = self.http.request('GET', url)
+            Metrics.set('olmappy_remote_list_fetch_seconds', time.perf_counter() - start, None, 'time to retrieve the remote map list')
             if (request.status >= 200 and request.status < 300):
+                Metrics.set('olmappy_remote_list_bytes', len(request.data), None, 'size of the remote map list')
                 try:
                     Debug('querying remote map list ' + url)
-                    self.maps = json.loads(request.data.decode('utf-8'))
+                    fingerprint = 'list:' + hashlib.sha1(request.data).hexdigest()
+                    if not self.loadSnapshot(fingerprint):
+                        with Profile.phase('parse remote list'):
+                            self.maps = json.loads(request.data.decode('utf-8'))
                     self.valid = True
                     Info('retrieved remote map list ' + url + ': ' + str(len(self.maps)) + ' entries')
+                    Metrics.set('olmappy_remote_list_entries', len(self.maps), None, 'entries in the remote map list')
                 except Exception as E:
                     raise OlmappyParseError('remote json map list ' + url + ' could not be parsed: ' + str(E)) from E
             else:
@@ -901,40 +3044,174 @@ class remoteMapManager(MapManager):
             self.valid = False
             raise OlmappyTransferError('failed to GET map list ' + url + ': ' + str(E)) from E
 
+    @Profiled('validate remote list')
     def validateMapList(self):
         if not self.valid:
             Warn(self.generic + ' map list is not in VALID state')
             return False
+        if self.prevalidated:
+            Info(self.name + ' map list: ' +str(len(self.maps)) + ' unique entries found')
+            if Config.settings['remoteHistory']:
+                self.getHistory().record(self.maps, self.timestamp)
+            return self.valid
         numEntries = len(self.maps)
-        numValidated = 0
-        mapsValidated = []
         Debug(self.name + ' map list: validating ' + str(numEntries) + ' entries')
-        for m in self.maps:
-            if self.validateMap(m):
-                mapsValidated = mapsValidated + [m]
-                numValidated = numValidated + 1
+        self.maps, rejects = self.validateMapBatch(self.maps)
+        numValidated = numEntries - sum(len(refs) for refs in rejects.values())
         Debug(self.name + ' map list: validated ' + str(numValidated) + ' out of ' + str(numEntries) + ' entries')
         if (numValidated < numEntries) :
             Warn(self.name + ' map list: ' + str(numEntries - numValidated) + ' entries were not correct')
-        self.maps = []
-        for m in mapsValidated:
-            myMap = self.findMapByFileName(m['filename'])
-            if myMap == None:
-                self.maps = self.maps + [m]
-            else:
-                if (myMap['mtime'] < m['mtime']) :
-                    Warn(self.name + ' map ' + mapName(m) + ' is newer than conflicting ' + mapName(myMap) + ', replacing it')
-                    self.maps.remove(myMap)
-                    self.maps = self.maps + [m]
-                else:
-                    Warn(self.name + ' map ' + mapName(m) + ' is older than conflicying ' + mapName(myMap) + ', ignoring it')
+            self.showRejects(rejects)
+        Metrics.set('olmappy_validation_failures', numEntries - numValidated, {'list': self.name}, 'map list entries which failed to validate')
         if (len(self.maps) < 1):
             Warn(self.name + ' map list: no valid entries found')
             self.valid = False
         else:
             Info(self.name + ' map list: ' +str(len(self.maps)) + ' unique entries found')
+            if Config.settings['remoteHistory']:
+                self.getHistory().record(self.maps, self.timestamp)
+            self.saveSnapshot(self.maps)
         return self.valid
 
+    def validateMapBatch(self, maps):
+        # validates the whole list with the same rules as validateMap: the
+        # first pass checks the structure of the entries, the second one fills
+        # in the derived fields and resolves entries with the same file name
+        # in favor of the newer one; returns the accepted maps in the same
+        # order as validating them one by one, and the rejected entries by
+        # reason
+        rejects = {}
+        typeCache = {}
+        checked = []
+        for idx, m in enumerate(maps):
+            reason = None
+            try:
+                if 'url' not in m:
+                    reason = 'missing URL'
+                elif len(m['url']) < 6:
+                    reason = 'malformed URL: too short'
+                elif m['url'][0] != '/':
+                    reason = 'malformed URL: does not start with /'
+                else:
+                    parts = m['url'].split('/')
+                    filename = urllib.parse.unquote(parts[-1])
+                    if len(parts[-2]) < 1:
+                        reason = 'malformed URL: empty ID part in id/filename'
+                    elif len(parts[-1]) < 1:
+                        reason = 'malformed URL: empty FILENAME part in id/filename'
+                    elif len(filename) < 1:
+                        reason = 'malformed URL: urldecoded FILENAME part was empty'
+                    elif 'size' in m and m['size'] < 1:
+                        reason = 'invalid map size'
+                    elif 'levels' not in m:
+                        reason = 'LEVELS part missing'
+                    elif len(m['levels']) < 1:
+                        reason = 'LEVELS part empty'
+                    else:
+                        for l in m['levels']:
+                            if 'type' not in l:
+                                reason = 'LEVEL without a type'
+                            elif 'name' not in l:
+                                reason = 'LEVEL without a name'
+                            elif l['type'] not in typeCache:
+                                try:
+                                    typeCache[l['type']] = MapType.MapTypeString(l['type'])
+                                except ValueError:
+                                    reason = 'unknown map type'
+                            if reason != None:
+                                break
+            except Exception as E:
+                reason = 'malformed entry: ' + type(E).__name__
+            if reason == None:
+                checked.append((m, parts, filename))
+            else:
+                rejects.setdefault(reason, []).append(m['url'] if isinstance(m, dict) and isinstance(m.get('url'), str) else '#' + str(idx))
+
+        cntNoTime = 0
+        cntNoSize = 0
+        cntReplaced = 0
+        cntIgnored = 0
+        selected = {}
+        for m, parts, filename in checked:
+            m['id'] = parts[-2]
+            m['filename_encoded'] = parts[-1]
+            m['filename'] = filename
+            if 'mtime' not in m:
+                m['mtime'] = self.timestamp
+                cntNoTime = cntNoTime + 1
+            if 'size' not in m:
+                m['size'] = -1 # will later be updated after download
+                cntNoSize = cntNoSize + 1
+            names = []
+            m['names'] = names
+            for l in m['levels']:
+                mt = typeCache[l['type']]
+                m['types'] = m['types'] | mt if 'types' in m else mt
+                if l['name'] not in names:
+                    names.append(l['name'])
+            if 'hidden' not in m:
+                m['hidden'] = 0
+            key = fileNameKey(filename)
+            myMap = selected.get(key)
+            if myMap == None:
+                selected[key] = m
+            elif myMap['mtime'] < m['mtime']:
+                Debug('%s map %s is newer than conflicting %s, replacing it', self.name, LazyMapName(m), LazyMapName(myMap))
+                # the newer map goes to the end, like in the validated list
+                del selected[key]
+                selected[key] = m
+                cntReplaced = cntReplaced + 1
+            else:
+                Debug('%s map %s is older than conflicting %s, ignoring it', self.name, LazyMapName(m), LazyMapName(myMap))
+                cntIgnored = cntIgnored + 1
+        if cntNoTime > 0:
+            Warn(self.name + ' map list: ' + str(cntNoTime) + ' maps have a missing mtime, faking it')
+        if cntNoSize > 0:
+            Warn(self.name + ' map list: ' + str(cntNoSize) + ' maps have a missing size')
+        if cntReplaced + cntIgnored > 0:
+            Warn(self.name + ' map list: ' + str(cntReplaced + cntIgnored) + ' maps with conflicting file names, ' + str(cntReplaced) + ' replaced by newer ones, ' + str(cntIgnored) + ' older ones ignored')
+        return list(selected.values()), rejects
+
+    def showRejects(self, rejects):
+        for reason, refs in sorted(rejects.items(), key=lambda r: len(r[1]), reverse=True):
+            examples = ', '.join(refs[:3]) + (', ...' if len(refs) > 3 else '')
+            Warn(self.name + ' map list: ' + str(len(refs)) + ' entries rejected, ' + reason + ': ' + examples)
+
+    def getHistory(self):
+        return RemoteHistory(self.getCacheFileName('remoteHistory.json'))
+
+    def showChanges(self, since):
+        added, removed = self.getHistory().changesSince(since)
+        addedNames = set()
+        cntAdded = 0
+        cntUpdated = 0
+        cntRemoved = 0
+        removedNames = set()
+        for raw in removed.values():
+            m = dict(raw)
+            if self.validateMap(m):
+                removedNames.add(fileNameKey(m['filename']))
+        for raw in added.values():
+            m = dict(raw)
+            if not self.validateMap(m) or not Filter.apply(m):
+                continue
+            key = fileNameKey(m['filename'])
+            addedNames.add(key)
+            if key in removedNames:
+                print('UPDATED: ' + mapDesc(m))
+                cntUpdated = cntUpdated + 1
+            else:
+                print('ADDED:   ' + mapDesc(m))
+                cntAdded = cntAdded + 1
+        for raw in removed.values():
+            m = dict(raw)
+            if not self.validateMap(m) or not Filter.apply(m):
+                continue
+            if fileNameKey(m['filename']) not in addedNames:
+                print('REMOVED: ' + mapDesc(m))
+                cntRemoved = cntRemoved + 1
+        Info('CHANGES: ' + str(cntAdded) + ' added, ' + str(cntUpdated) + ' updated, ' + str(cntRemoved) + ' removed')
+
     def update(self, forceRefresh = False):
         if forceRefresh:
             self.valid = False
@@ -947,19 +3224,55 @@ class remoteMapManager(MapManager):
             self.valid = False
         return self.valid
 
+    @Profiled('download')
     def download(self, m, outFileName):
         try:
             url = Config.settings['mapServer'] +  m['url']
-            outFile = open(outFileName, 'wb')
-            Debug('attempting to download ' + url)
-            request = self.http.request('GET', url, preload_content = False)
+            Profile.annotate('url', url)
+            start = time.perf_counter()
+            offset = 0
+            try:
+                offset = os.stat(outFileName).st_size
+            except FileNotFoundError:
+                pass
+            if offset > 0 and offset == m['size']:
+                Debug('already downloaded ' + url)
+                return
+            headers = {}
+            if offset > 0:
+                Debug('attempting to resume download of ' + url + ' at ' + str(offset))
+                headers['Range'] = 'bytes=' + str(offset) + '-'
+            else:
+                Debug('attempting to download ' + url)
+            request = self.http.request('GET', url, preload_content = False, headers = headers)
+            if request.status == 206 and offset > 0:
+                outFile = open(outFileName, 'ab')
+            elif request.status >= 200 and request.status < 300:
+                outFile = open(outFileName, 'wb')
+            else:
+                request.release_conn()
+                if request.status == 416:
+                    os.remove(outFileName)
+                raise OlmappyTransferError('request failed with status code ' + str(request.status))
             for chunk in request.stream(64*1024):
+                self.bandwidth.consume(len(chunk))
+                Background.io(len(chunk))
                 outFile.write(chunk)
             outFile.flush()
+            received = outFile.tell() - offset if request.status == 206 else outFile.tell()
+            Profile.annotate('bytes', received)
+            Metrics.inc('olmappy_downloaded_bytes', received, None, 'bytes downloaded in this run')
+            Metrics.observe('olmappy_download_duration_seconds', time.perf_counter() - start, 'duration of the map downloads')
             if m['size'] < 0:
                 m['size'] = outFile.tell()
                 Warn('assuming retrieved file size for ' + url + ' is correct: ' +str(m['size']))
+            size = outFile.tell()
             outFile.close()
+            if m['size'] > 0 and size != m['size']:
+                # a short file is resumed next time, a long one is useless
+                if size > m['size']:
+                    os.remove(outFileName)
+                raise OlmappyTransferError('received ' + str(size) + ' bytes, expected ' + str(m['size']))
         except Exception as E:
             text = 'failed to download ' + url + ' to "' + outFileName + '": ' + str(E)
             Warn(text)
@@ -1038,6 +3351,9 @@ class MapFilter:
         self.validateStringFilter(self.names, self.filterCaseSensitive)
         self.validateStringFilter(self.filenames, self.filenameCaseSensitive)
 
+    def hasStringFilters(self):
+        return len(self.names) > 0 or len(self.filenames) > 0
+
     def isEmpty(self):
         if len(self.names) > 0:
             return False
@@ -1082,6 +3398,184 @@ class MapFilter:
                 return False
         return True
 
+##############################################################################
+# class for the trigram index over map names and filenames                  #
+##############################################################################
+
+class TrigramIndex:
+    # maps each (casefolded) trigram of the level names and filenames to the
+    # positions of the maps containing it; the index is only valid for the
+    # map list it was built from, identified by its version
+    loaded = {}
+
+    def __init__(self, version):
+        self.version = version
+        self.names = {}
+        self.filenames = {}
+
+    @staticmethod
+    def getVersion(maps):
+        h = hashlib.sha1()
+        for m in maps:
+            h.update((m['id'] + '\t' + m['filename'] + '\t' + '\t'.join(m['names']) + '\n').encode('utf-8'))
+        return h.hexdigest()
+
+    @staticmethod
+    def trigrams(s):
+        s = s.casefold()
+        return set(s[i:i+3] for i in range(len(s) - 2))
+
+    def build(self, maps):
+        for pos, m in enumerate(maps):
+            grams = set()
+            for n in m['names']:
+                grams.update(self.trigrams(n))
+            for g in grams:
+                self.names.setdefault(g, []).append(pos)
+            for g in self.trigrams(m['filename']):
+                self.filenames.setdefault(g, []).append(pos)
+
+    @classmethod
+    def load(cls, filename, maps, version):
+        # the index read or built last is kept for the rest of the process
+        index = cls.loaded.get(filename)
+        if index != None and index.version == version:
+            return index
+        try:
+            f = open(file = filename, mode = 'rt', encoding = 'utf-8')
+            data = json.load(f)
+            f.close()
+            if data['version'] == version:
+                index = cls(version)
+                index.names = data['names']
+                index.filenames = data['filenames']
+                cls.loaded[filename] = index
+                Debug('read trigram index ' + filename)
+                return index
+        except FileNotFoundError:
+            pass
+        except Exception as E:
+            Warn('trigram index ' + filename + ' could not be read: ' + str(E))
+        index = cls(version)
+        index.build(maps)
+        cls.loaded[filename] = index
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            f = open(file = filename + '.tmp', mode = 'wt', encoding = 'utf-8')
+            json.dump({'version': version, 'names': index.names, 'filenames': index.filenames}, f, separators=(',', ':'))
+            Background.io(f.tell())
+            f.close()
+            os.replace(filename + '.tmp', filename)
+            Debug('wrote trigram index ' + filename)
+        except Exception as E:
+            Warn('trigram index ' + filename + ' could not be written: ' + str(E))
+        return index
+
+    def lookup(self, postings, value):
+        # returns the set of candidate positions, or None if value is too short
+        grams = self.trigrams(value)
+        if len(grams) < 1:
+            return None
+        result = None
+        for g in sorted(grams, key = lambda g: len(postings.get(g, ()))):
+            p = postings.get(g)
+            if p == None:
+                return set()
+            result = set(p) if result == None else result.intersection(p)
+            if len(result) < 1:
+                break
+        return result
+
+    def lookupAny(self, postings, filters):
+        # filters of the same category are OR-combined
+        result = set()
+        for f in filters:
+            p = self.lookup(postings, f.value)
+            if p == None:
+                return None
+            result.update(p)
+        return result
+
+    def candidates(self, maps, mapFilter):
+        positions = None
+        for postings, filters in [(self.names, mapFilter.names), (self.filenames, mapFilter.filenames)]:
+            if len(filters) < 1:
+                continue
+            p = self.lookupAny(postings, filters)
+            if p != None:
+                positions = p if positions == None else positions.intersection(p)
+        if positions == None:
+            return maps
+        return [maps[pos] for pos in sorted(positions)]
+
+##############################################################################
+# class for the time index over the map mtimes                               #
+##############################################################################
+
+class TimeIndex:
+    # the maps sorted by (mtime, seq), where seq is the order in which the
+    # maps were added, so maps with equal mtime stay in list order
+    def __init__(self, maps):
+        self.source = maps
+        self.keys = sorted((m['mtime'], i) for i, m in enumerate(maps))
+        self.maps = [maps[i] for t, i in self.keys]
+        self.mapKeys = {}
+        for k, m in zip(self.keys, self.maps):
+            self.mapKeys[id(m)] = k
+        self.nextSeq = len(maps)
+
+    def add(self, m):
+        k = (m['mtime'], self.nextSeq)
+        self.nextSeq = self.nextSeq + 1
+        idx = bisect.bisect_right(self.keys, k)
+        self.keys.insert(idx, k)
+        self.maps.insert(idx, m)
+        self.mapKeys[id(m)] = k
+
+    def remove(self, m):
+        k = self.mapKeys.pop(id(m), None)
+        if k == None:
+            return None
+        idx = bisect.bisect_left(self.keys, k)
+        if idx < len(self.keys) and self.keys[idx] == k:
+            del self.keys[idx]
+            del self.maps[idx]
+        return k
+
+    def update(self, m):
+        # the mtime of m changed, it keeps its place in the list order
+        k = self.remove(m)
+        if k == None:
+            return
+        k = (m['mtime'], k[1])
+        idx = bisect.bisect_right(self.keys, k)
+        self.keys.insert(idx, k)
+        self.maps.insert(idx, m)
+        self.mapKeys[id(m)] = k
+
+    def bounds(self, after, before):
+        # maps with after <= mtime < before, either bound may be None
+        lo = 0 if after == None else bisect.bisect_left(self.keys, (after,))
+        hi = len(self.keys) if before == None else bisect.bisect_left(self.keys, (before,))
+        return lo, max(lo, hi)
+
+    def range(self, after, before):
+        # the maps in the time range, in list order
+        lo, hi = self.bounds(after, before)
+        return [self.maps[i] for i in sorted(range(lo, hi), key = lambda i: self.keys[i][1])]
+
+    def ordered(self, reverse, after = None, before = None):
+        # the maps in the time range by mtime, maps with equal mtime in list order
+        lo, hi = self.bounds(after, before)
+        if not reverse:
+            yield from self.maps[lo:hi]
+            return
+        end = hi
+        while end > lo:
+            start = bisect.bisect_left(self.keys, (self.keys[end - 1][0],), lo, end)
+            yield from self.maps[start:end]
+            end = start
+
 ##############################################################################
 # class for configuration settings                                           #
 ##############################################################################
@@ -1093,13 +3587,43 @@ class Settings:
         self.settings['mapServer'] = 'https://overloadmaps.com'
         self.settings['mapServerListURL'] = '/data/all.json'
         self.settings['logLevel'] = LogLevel.INFO
+        self.settings['logFormat'] = 'text'
+        self.settings['logRepeatLimit'] = 10
+        self.settings['metricsFile'] = ''
+        self.settings['trigramIndex'] = True
+        self.settings['catalogueSnapshots'] = True
         self.settings['filenameCaseSensitive'] = False
         self.settings['filterCaseSensitive'] = False
         self.settings['removeUnknownMaps'] = False
         self.settings['autoImport'] = True
+        self.settings['offlineImport'] = False
+        self.settings['renameImport'] = True
+        self.settings['importBatchSize'] = 1000
+        self.settings['checkArchives'] = True
+        self.settings['replaceCorruptMaps'] = False
+        self.settings['workerThreads'] = min(8, os.cpu_count() or 1)
+        self.settings['replacedMaxSize'] = 0
+        self.settings['replacedMaxAge'] = 0
+        self.settings['autoPrune'] = False
+        self.settings['remoteHistory'] = True
+        self.settings['maxDownloadRate'] = 0
+        self.settings['maxConnections'] = 2
+        self.settings['downloadOrder'] = ''
+        self.settings['diskReserve'] = 64
+        self.settings['background'] = False
+        self.settings['backgroundDiskRate'] = 4096
+        self.settings['backgroundPause'] = 20
+        self.settings['syncTypes'] = ''
+        self.settings['syncMaxAge'] = 0
+        self.settings['syncMaxMapSize'] = 0
+        self.settings['syncDiskBudget'] = 0
+        self.settings['syncKeepOrder'] = 'mtime:desc'
         self.settings['configFile'] = getConfigDir() + 'olmappy.json'
         self.settings['verifyCertificates'] = True
         self.settings['certificateBundle'] = ''
+        self.settings['httpRecord'] = ''
+        self.settings['httpReplay'] = ''
+        self.settings['httpReplaySpeed'] = 1.0
 
     def applySettings(self, newSettings):
         for name, value in newSettings.items():
@@ -1123,8 +3647,60 @@ class Settings:
         self.validatebool('filenameCaseSensitive')
         self.validatebool('filterCaseSensitive')
         self.validatebool('autoImport')
+        self.validatebool('offlineImport')
+        self.validatebool('renameImport')
+        self.validatebool('checkArchives')
+        self.validatebool('replaceCorruptMaps')
+        self.validatebool('autoPrune')
+        self.validatebool('remoteHistory')
+        self.validatebool('trigramIndex')
+        self.validatebool('catalogueSnapshots')
         self.validatebool('verifyCertificates')
+        self.validatebool('background')
         self.validateint('logLevel')
+        self.validateint('logRepeatLimit')
+        if self.settings['logFormat'] not in ['text', 'json']:
+            self.settings['logFormat'] = 'text'
+            Warn('invalid logFormat, using "' + self.settings['logFormat'] + '" instead')
+        self.validateint('workerThreads')
+        self.validateint('replacedMaxSize')
+        self.validateint('replacedMaxAge')
+        self.validateint('maxDownloadRate')
+        self.validateint('maxConnections')
+        self.validateint('diskReserve')
+        self.validateint('backgroundDiskRate')
+        self.validateint('backgroundPause')
+        if self.settings['backgroundDiskRate'] < 0:
+            self.settings['backgroundDiskRate'] = 0
+        if self.settings['backgroundPause'] < 0:
+            self.settings['backgroundPause'] = 0
+        self.validateint('importBatchSize')
+        if self.settings['importBatchSize'] < 1:
+            self.settings['importBatchSize'] = 1
+        if type(self.settings['httpReplaySpeed']) is str:
+            self.settings['httpReplaySpeed'] = float(self.settings['httpReplaySpeed'])
+        self.validateint('syncMaxAge')
+        self.validateint('syncMaxMapSize')
+        self.validateint('syncDiskBudget')
+        for t in self.settings['syncTypes'].split(','):
+            t = t.strip()
+            if len(t) < 1:
+                continue
+            try:
+                MapType.MapTypeString(t)
+            except ValueError:
+                self.settings['syncTypes'] = ''
+                Warn('invalid syncTypes, using "' + self.settings['syncTypes'] + '" instead')
+                break
+        try:
+            MapManager.parseSortOrder(self.settings['syncKeepOrder'])
+        except OlmappyConfigError as E:
+            self.settings['syncKeepOrder'] = 'mtime:desc'
+            Warn('invalid syncKeepOrder: ' + str(E) + ', using "' + self.settings['syncKeepOrder'] + '" instead')
+        if self.settings['maxConnections'] < 1:
+            self.settings['maxConnections'] = 1
+        if self.settings['workerThreads'] < 1:
+            self.settings['workerThreads'] = 1
 
     def load(self, configFile = None, errorOk = True):
         newSettings = {}
@@ -1237,22 +3813,63 @@ class Commandline:
         self.parser.add_argument('-E', '--export-file',
                                  action = 'store',
                                  nargs = 1,
-                                 default = 'olmappyExport.json',
-                                 help = 'for EXPORT... operations: the filename to write to, default is "%(default)s".')
+                                 default = ['olmappyExport.json'],
+                                 help = 'for EXPORT... operations: the filename to write to, default is "olmappyExport.json".')
         self.parser.add_argument('-I', '--import-file',
                                  action = 'store',
                                  nargs = 1,
-                                 default = 'olmappyExport.json',
-                                 help = 'for IMPORT... operations: the filename to read from, default is "%(default)s".')
+                                 default = ['olmappyExport.json'],
+                                 help = 'for IMPORT... operations: the filename to read from, default is "olmappyExport.json".')
+        self.parser.add_argument('--format',
+                                 nargs = 1,
+                                 choices = MapListWriter.formats,
+                                 help = 'for LIST... and EXPORTLIST operations: the output format, default is text for LIST... and json for EXPORTLIST.')
+        self.parser.add_argument('--sort',
+                                 nargs = 1,
+                                 metavar = 'KEY',
+                                 help = 'for LIST... and EXPORTLIST operations: sort by the comma-separated KEYs (mtime, size, type, name), append :desc for descending order.')
+        self.parser.add_argument('--limit',
+                                 type = int,
+                                 nargs = 1,
+                                 metavar = 'N',
+                                 help = 'for LIST... and EXPORTLIST operations: output at most N maps.')
+        self.parser.add_argument('--since',
+                                 type = parseDateTime,
+                                 metavar = 'DATETIME',
+                                 nargs = 1,
+                                 help = 'for CHANGES: list the changes to the remote map list since DATETIME, default is the last update of the history.')
         self.parser.add_argument('--reverse',
                                  action = 'store_true',
                                  default = 'olmappyExport.json',
                                  help = 'for HIDEIMPORT: reverse the "hidden" state of the imported map files.')
+        self.parser.add_argument('--peer-manifest',
+                                 nargs = 1,
+                                 metavar = 'FILE',
+                                 help = 'for EXPORTMANIFEST: only include the entries of the chunks which differ from the manifest in FILE.')
+        self.parser.add_argument('--digests-only',
+                                 action = 'store_true',
+                                 help = 'for EXPORTMANIFEST: only write the digests, not the entries.')
+        self.parser.add_argument('--background',
+                                 action = 'store_true',
+                                 help = 'run with the lowest CPU and I/O priority, and pace the disk accesses, see the background... config options.')
+        self.parser.add_argument('--profile',
+                                 action = 'store_true',
+                                 help = 'print the time spent in each phase of the operation at the end.')
+        self.parser.add_argument('--profile-out',
+                                 nargs = 1,
+                                 metavar = 'FILE',
+                                 help = 'write a cProfile dump of the operation to FILE, for use with pstats.')
+        self.parser.add_argument('--trace',
+                                 nargs = 1,
+                                 metavar = 'FILE',
+                                 help = 'write a timeline of the operation to FILE, in the trace event format of chrome://tracing and Perfetto.')
         self.parser.add_argument('--version', action='version', version='%(prog)s 1.2.0')
         self.parser.epilog = 'See README.md for details.'
 
-    def parse(self):
-        self.args = self.parser.parse_args()
+    def parse(self, argv = None):
+        self.args = self.parser.parse_args(argv)
+        if self.args.limit != None and self.args.limit[0] < 0:
+            self.parser.error('argument --limit: must not be negative')
 
         if self.args.set != None:
             for s in self.args.set:
@@ -1288,6 +3905,8 @@ class Commandline:
         Filter.hidden = self.args.hidden
         Filter.unhidden = self.args.unhidden
         Filter.explicitApplyToAll = self.args.all
+        Profile.enable(self.args.profile, self.args.trace[0] if self.args.trace != None else None)
+        Background.enable(self.args.background or Config.settings['background'])
         Filter.validate()
         return self.args.operation
 
@@ -1307,6 +3926,12 @@ class Operation(enum.IntEnum):
     LISTIGNORED = 9
     EXPORTLIST = 10
     HIDEIMPORT = 11
+    VERIFY = 12
+    PRUNE = 13
+    PLAN = 14
+    CHANGES = 15
+    EXPORTMANIFEST = 16
+    HIDESYNC = 17
 
     def apply(self):
         operations = [
@@ -1321,19 +3946,55 @@ class Operation(enum.IntEnum):
             self.doShowConfig,
             self.doListIgnored,
             self.doExportList,
-            self.doHideImport
+            self.doHideImport,
+            self.doVerify,
+            self.doPrune,
+            self.doPlan,
+            self.doChanges,
+            self.doExportManifest,
+            self.doHideSync
         ]
 
         res = 999
+        start = time.perf_counter()
+        profiler = None
+        if Cmd.args.profile_out != None:
+            profiler = cProfile.Profile()
+            profiler.enable()
         try:
-            res = operations[self.value]()
+            with Profile.phase(self.asString()):
+                res = operations[self.value]()
             if res != 0:
                 Error('Operation ' + self.asString() + ' failed with code: ' + str(res))
         except Exception as E:
             Error('Operation ' + self.asString() + ' failed: ' + str(E))
             res = 998
+        if profiler != None:
+            profiler.disable()
+            try:
+                profiler.dump_stats(Cmd.args.profile_out[0])
+                Info('wrote profile to "' + Cmd.args.profile_out[0] + '"')
+            except Exception as E:
+                Warn('profile could not be written to "' + Cmd.args.profile_out[0] + '": ' + str(E))
+        if len(Config.settings['metricsFile']) > 0 and self.writesMetrics():
+            labels = {'operation': self.asString()}
+            Metrics.set('olmappy_run_success', 1 if res == 0 else 0, labels, 'whether the last run succeeded')
+            Metrics.set('olmappy_run_duration_seconds', time.perf_counter() - start, labels, 'duration of the last run')
+            Metrics.set('olmappy_run_timestamp_seconds', time.time(), labels, 'end time of the last run')
+            Metrics.write(Config.settings['metricsFile'])
+        LogSummary()
+        if Profile.summary:
+            Profile.show()
+        if Profile.traceFile != None:
+            Profile.writeTrace()
         return res
 
+    def writesMetrics(self):
+        # only the operations which synchronize or change the maps write to
+        # the metrics file, the series of the other operations in it are kept
+        return self in [Operation.IMPORT, Operation.UPDATE, Operation.HIDE, Operation.UNHIDE, Operation.HIDEIMPORT,
+                        Operation.VERIFY, Operation.PRUNE, Operation.HIDESYNC]
+
     def asString(self):
         for name, value in Operation.__members__.items():
             if value == self.value:
@@ -1366,6 +4027,8 @@ class Operation(enum.IntEnum):
             local.importFromRemote(remote)
         local.updateFromRemote(remote)
         local.saveMapList()
+        if Config.settings['autoPrune']:
+            local.pruneReplaced()
         return 0
 
     def doList(self, local=True, doExport=False):
@@ -1384,14 +4047,12 @@ class Operation(enum.IntEnum):
         local = localMapManager()
         local.update()
         local.hideMaps(True)
-        local.saveMapList()
         return 0
 
     def doUnhide(self):
         local = localMapManager()
         local.update()
         local.hideMaps(False)
-        local.saveMapList()
         return 0
 
     def doWriteConfig(self):
@@ -1415,9 +4076,56 @@ class Operation(enum.IntEnum):
         local = localMapManager()
         local.update()
         local.hideImport(Cmd.args.import_file[0])
+        return 0
+
+    def doExportManifest(self):
+        local = localMapManager()
+        local.update()
+        peer = Cmd.args.peer_manifest[0] if Cmd.args.peer_manifest != None else None
+        local.exportManifest(Cmd.args.export_file[0], peer, not Cmd.args.digests_only)
+        return 0
+
+    def doHideSync(self):
+        local = localMapManager()
+        local.update()
+        local.syncHidden(Cmd.args.import_file[0])
+        return 0
+
+    def doVerify(self):
+        local = localMapManager()
+        local.update()
+        local.verifyMaps()
         local.saveMapList()
         return 0
 
+    def doPlan(self):
+        local = localMapManager()
+        remote = remoteMapManager()
+        local.update()
+        if not remote.update():
+            raise OlmappyUpdateError('remote map list could not be updated')
+        local.planFromRemote(remote).show()
+        return 0
+
+    def doChanges(self):
+        remote = remoteMapManager()
+        since = None
+        if Cmd.args.since != None:
+            since = Cmd.args.since[0]
+        else:
+            since = remote.getHistory().getLastTime()
+        if since == None:
+            Warn('CHANGES: no remote history recorded yet')
+            return 0
+        remote.showChanges(since)
+        return 0
+
+    def doPrune(self):
+        local = localMapManager()
+        local.update()
+        local.pruneReplaced()
+        return 0
+
 
 ##############################################################################
 # main program entry point                                                   #
@@ -1425,8 +4133,11 @@ class Operation(enum.IntEnum):
 
 Config = Settings()
 Filter = MapFilter()
+Profile = Profiler()
+Metrics = MetricsCollector()
+Background = BackgroundMode()
 Cmd = Commandline()
 
-operation = Cmd.parse()
-
-exit(operation.apply())
+if __name__ == '__main__':
+    operation = Cmd.parse()
+    exit(operation.apply())
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+
+# Memory benchmark for olmap.py: runs the main operations on generated map
+# catalogues of growing size, records the peak memory and the top allocation
+# sites of each phase, and compares the results against a baseline
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import olmap
+import olmapsim
+
+##############################################################################
+# measuring the phases                                                       #
+##############################################################################
+
+class PhaseRecorder:
+    phases = ['list', 'filter', 'export', 'update', 'reload']
+    # phases which work on the remote map list of the list phase
+    needsList = ['filter', 'export', 'update']
+
+    def __init__(self, top, trace):
+        self.top = top
+        self.trace = trace
+        self.results = []
+
+    @staticmethod
+    def getRSS():
+        # current resident set size in bytes, or None if not available
+        try:
+            f = open('/proc/self/statm', 'rt')
+            pages = int(f.read().split()[1])
+            f.close()
+        except (OSError, ValueError, IndexError):
+            return None
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    @staticmethod
+    def resetPeakRSS():
+        # resets the peak RSS of the process to the current RSS, returns
+        # False if this is not possible (only Linux supports it)
+        try:
+            f = open('/proc/self/clear_refs', 'wt')
+            f.write('5')
+            f.close()
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def getPeakRSS():
+        # peak resident set size in bytes since the last reset
+        try:
+            f = open('/proc/self/status', 'rt')
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    f.close()
+                    return int(line.split()[1]) * 1024
+            f.close()
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    @staticmethod
+    def getSite(traceback):
+        # attribute an allocation to the innermost frame in olmap.py, so the
+        # allocations done by json, urllib etc. on its behalf are counted
+        # there; this needs more than one frame per allocation, see --frames
+        for frame in reversed(traceback):
+            if frame.filename == olmap.__file__:
+                return os.path.basename(frame.filename) + ':' + str(frame.lineno)
+        frame = traceback[-1]
+        return os.path.basename(frame.filename) + ':' + str(frame.lineno)
+
+    @staticmethod
+    def takeSnapshot():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')])
+
+    def getTopSites(self, before, after):
+        sites = {}
+        for stat in after.compare_to(before, 'traceback'):
+            if stat.size_diff <= 0:
+                continue
+            site = self.getSite(stat.traceback)
+            size, count = sites.get(site, (0, 0))
+            sites[site] = (size + stat.size_diff, count + max(stat.count_diff, 0))
+        ordered = sorted(sites.items(), key=lambda s: s[1][0], reverse=True)
+        return [{'site': site, 'size': size, 'count': count} for site, (size, count) in ordered[:self.top]]
+
+    def run(self, name, func):
+        if self.trace:
+            before = self.takeSnapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        peakReset = self.resetPeakRSS()
+        start = time.perf_counter()
+        info = func()
+        seconds = time.perf_counter() - start
+        result = {'phase': name, 'seconds': seconds}
+        if self.trace:
+            after, phasePeak = tracemalloc.get_traced_memory()
+            result['peak'] = phasePeak - current
+            result['retained'] = after - current
+            result['top'] = self.getTopSites(before, self.takeSnapshot())
+        result['rss'] = self.getRSS()
+        # without a reset, only the peak RSS of the whole process is known,
+        # which includes the earlier phases and is not compared
+        if peakReset:
+            result['peakRSS'] = self.getPeakRSS()
+        else:
+            result['maxRSS'] = olmap.Profiler.getPeakRSS()
+        if info != None:
+            result.update(info)
+        self.results.append(result)
+
+##############################################################################
+# benchmark worker, runs in its own process for each catalogue size          #
+##############################################################################
+
+class BenchWorker:
+    def __init__(self, args):
+        self.args = args
+        self.remote = None
+        self.local = None
+
+    def configure(self, server, workDir):
+        mapPath = workDir + '/maps/'
+        os.makedirs(mapPath, exist_ok=True)
+        argv = ['-s', 'configFile', workDir + '/olmappy.json',
+                '-s', 'mapPath', mapPath,
+                '-s', 'mapServer', server.getURL(),
+                '-s', 'logLevel', str(olmap.LogLevel.ERROR),
+                '-s', 'maxConnections', str(self.args.connections)]
+        for name, value in self.args.set or []:
+            argv = argv + ['-s', name, value]
+        argv = argv + ['-n', self.args.filter, '-E', workDir + '/export.json']
+        olmap.Cmd.parse(argv + ['EXPORTLIST'])
+
+    def doList(self):
+        self.remote = olmap.remoteMapManager()
+        if not self.remote.update():
+            raise RuntimeError('failed to get the remote map list')
+        return {'maps': len(self.remote.maps)}
+
+    def doFilter(self):
+        matched = [m for m in self.remote.getFilterCandidates() if olmap.Filter.apply(m)]
+        return {'matched': len(matched)}
+
+    def doExport(self):
+        self.remote.listMaps(True)
+
+    def doUpdate(self):
+        self.local = olmap.localMapManager()
+        self.local.update()
+        self.local.updateFromRemote(self.remote)
+        self.local.saveMapList()
+        return {'maps': len(self.local.maps)}
+
+    def doReload(self):
+        # drop the lists of the earlier phases, so only the reload is retained
+        self.local = None
+        self.remote = None
+        local = olmap.localMapManager()
+        local.update()
+        return {'maps': len(local.maps)}
+
+    def run(self, count):
+        catalogue = olmapsim.SimCatalogue(count, self.args.min_size, self.args.max_size, self.args.seed)
+        server = olmapsim.SimServer(catalogue, olmapsim.FaultConfig(), self.args.seed)
+        server.start()
+        workDir = tempfile.mkdtemp(prefix='olmapbench-')
+        try:
+            self.configure(server, workDir)
+            recorder = PhaseRecorder(self.args.top, not self.args.no_trace)
+            baseline = {'maps': count, 'rss': recorder.getRSS(), 'peakRSS': olmap.Profiler.getPeakRSS()}
+            if recorder.trace:
+                tracemalloc.start(self.args.frames)
+            for name in PhaseRecorder.phases:
+                if name not in self.args.phases:
+                    continue
+                if name in PhaseRecorder.needsList and self.remote == None:
+                    # the list is loaded outside of the measured phases
+                    self.doList()
+                recorder.run(name, getattr(self, 'do' + name.capitalize()))
+            tracemalloc.stop()
+        finally:
+            server.stop()
+            shutil.rmtree(workDir, ignore_errors=True)
+        baseline['phases'] = recorder.results
+        return baseline
+
+##############################################################################
+# results and comparison                                                     #
+##############################################################################
+
+def formatSize(size):
+    if size == None:
+        return 'n/a'
+    return '%.1f MiB' % (size / (1024 * 1024))
+
+def showRun(run, top):
+    print(str(run['maps']) + ' maps, RSS before the first phase ' + formatSize(run['rss']))
+    for p in run['phases']:
+        line = '    %-7s %7.2f s' % (p['phase'] + ':', p['seconds'])
+        if 'peak' in p:
+            line = line + ', peak ' + formatSize(p['peak']) + ', retained ' + formatSize(p['retained'])
+        line = line + ', RSS ' + formatSize(p['rss'])
+        if 'peakRSS' in p:
+            line = line + ', peak RSS ' + formatSize(p['peakRSS'])
+        else:
+            line = line + ', process peak RSS ' + formatSize(p.get('maxRSS'))
+        print(line)
+        for s in p.get('top', [])[:top]:
+            print('        %-24s %10s in %d blocks' % (s['site'], formatSize(s['size']), s['count']))
+
+def compareResults(base, results, threshold, minBytes):
+    # compare the peak memory of each phase which is in both results, returns
+    # the number of regressions
+    baseRuns = {}
+    for run in base['runs']:
+        for p in run['phases']:
+            baseRuns[(run['maps'], p['phase'])] = p
+    cntRegressions = 0
+    for run in results['runs']:
+        for p in run['phases']:
+            b = baseRuns.get((run['maps'], p['phase']))
+            if b == None:
+                continue
+            for key in ['peak', 'peakRSS']:
+                if p.get(key) == None or b.get(key) == None:
+                    continue
+                diff = p[key] - b[key]
+                change = 100.0 * diff / b[key] if b[key] > 0 else 0.0
+                regression = diff > minBytes and p[key] > b[key] * (1.0 + threshold / 100.0)
+                if regression:
+                    cntRegressions = cntRegressions + 1
+                print('%6d maps %-7s %-8s %12s -> %12s %+7.1f%%%s' % (run['maps'], p['phase'], key, formatSize(b[key]), formatSize(p[key]), change, '  REGRESSION' if regression else ''))
+    return cntRegressions
+
+def runWorker(args, count):
+    # each catalogue size runs in a fresh process, so the peak RSS of one
+    # size does not hide the one of the next
+    f, outFile = tempfile.mkstemp(prefix='olmapbench-', suffix='.json')
+    os.close(f)
+    argv = [sys.executable, os.path.abspath(__file__), '--worker', str(count), '--output', outFile,
+            '--min-size', str(args.min_size), '--max-size', str(args.max_size), '--seed', str(args.seed),
+            '--connections', str(args.connections), '--filter', args.filter, '--top', str(args.top),
+            '--frames', str(args.frames), '--phases', ','.join(args.phases)]
+    if args.no_trace:
+        argv.append('--no-trace')
+    for name, value in args.set or []:
+        argv = argv + ['-s', name, value]
+    try:
+        subprocess.run(argv, check=True)
+        f = open(file = outFile, mode = 'rt', encoding = 'utf-8')
+        run = json.load(f)
+        f.close()
+    finally:
+        os.remove(outFile)
+    return run
+
+##############################################################################
+# main program entry point                                                   #
+##############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory used by olmappy on generated map catalogues of growing size.')
+    parser.add_argument('--maps', default='250,500,1000,2000', help='comma separated list of catalogue sizes')
+    parser.add_argument('--phases', default=','.join(PhaseRecorder.phases), help='comma separated list of the phases to run: ' + ', '.join(PhaseRecorder.phases))
+    parser.add_argument('--min-size', type=int, default=256, help='minimum map size in bytes')
+    parser.add_argument('--max-size', type=int, default=1024, help='maximum map size in bytes')
+    parser.add_argument('--connections', type=int, default=4, help='value for the maxConnections setting')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the catalogue')
+    parser.add_argument('--filter', default='MAP 1', help='name filter for the filter and export phases')
+    parser.add_argument('-s', '--set', action='append', nargs=2, metavar=('NAME', 'VALUE'), help='set olmappy configuration option NAME to VALUE')
+    parser.add_argument('--top', type=int, default=10, help='number of allocation sites to record per phase')
+    parser.add_argument('--frames', type=int, default=1, help='number of frames tracemalloc stores per allocation, more frames attribute the allocations in library code to the calling line in olmap.py, but are slower')
+    parser.add_argument('--no-trace', action='store_true', help='do not use tracemalloc, only measure the RSS and time')
+    parser.add_argument('--show-top', type=int, default=3, help='number of allocation sites to show per phase')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON to FILE')
+    parser.add_argument('--load', metavar='FILE', help='do not run the benchmark, but load the results from FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the peak memory with the results in FILE')
+    parser.add_argument('--threshold', type=float, default=10.0, help='increase of the peak memory in percent which is reported as regression')
+    parser.add_argument('--min-bytes', type=int, default=256*1024, help='smallest increase of the peak memory which is reported as regression')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.phases = [p for p in args.phases.split(',') if p != '']
+    for p in args.phases:
+        if p not in PhaseRecorder.phases:
+            parser.error('unknown phase "' + p + '"')
+
+    if args.worker != None:
+        run = BenchWorker(args).run(args.worker)
+        f = open(file = args.output, mode = 'wt', encoding = 'utf-8')
+        json.dump(run, f)
+        f.close()
+        return 0
+
+    if args.load != None:
+        f = open(file = args.load, mode = 'rt', encoding = 'utf-8')
+        results = json.load(f)
+        f.close()
+    else:
+        results = {
+            'version': 1,
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'settings': {'minSize': args.min_size, 'maxSize': args.max_size, 'seed': args.seed, 'filter': args.filter, 'set': args.set or []},
+            'runs': []
+        }
+        for count in [int(c) for c in args.maps.split(',') if c != '']:
+            run = runWorker(args, count)
+            showRun(run, args.show_top)
+            results['runs'].append(run)
+    if args.json != None:
+        f = open(file = args.json, mode = 'wt', encoding = 'utf-8')
+        json.dump(results, f, indent=4)
+        f.close()
+    if args.compare != None:
+        f = open(file = args.compare, mode = 'rt', encoding = 'utf-8')
+        base = json.load(f)
+        f.close()
+        if base.get('settings') != results.get('settings'):
+            print('warning: the results were measured with different settings')
+        cntRegressions = compareResults(base, results, args.threshold, args.min_bytes)
+        print(str(cntRegressions) + ' regressions')
+        return 1 if cntRegressions > 0 else 0
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+# Local map server simulator with fault injection, and a scenario runner
+# which synchronizes a scratch map directory against it using olmap.py
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+import olmap
+
+##############################################################################
+# generated map catalogue                                                    #
+##############################################################################
+
+class SimCatalogue:
+    levelTypes = [['mp'], ['cm', 'mp'], ['sp'], ['mp', 'sp']]
+
+    def __init__(self, count, minSize, maxSize, seed):
+        rng = random.Random(seed)
+        self.entries = []
+        self.files = {}
+        for i in range(count):
+            mapId = '%032x' % rng.getrandbits(128)
+            name = 'Sim Map ' + str(i)
+            filename = name.replace(' ', '_') + '.zip'
+            types = rng.choice(self.levelTypes)
+            data = self.makeArchive(rng, name, types, rng.randint(minSize, maxSize))
+            url = '/' + mapId + '/' + urllib.parse.quote(filename)
+            self.files[url] = data
+            self.entries.append({
+                'url': url,
+                'mtime': 1600000000 + i * 3600,
+                'size': len(data),
+                'levels': [{'type': t, 'name': name.upper()} for t in types]
+            })
+        self.listData = json.dumps(self.entries).encode('utf-8')
+
+    @staticmethod
+    def makeArchive(rng, name, types, size):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
+            for t in types:
+                z.writestr(name.replace(' ', '_').lower() + '.' + t, 'level ' + name + '\n')
+            z.writestr('data.bin', rng.randbytes(size))
+        return buf.getvalue()
+
+    def getDigests(self):
+        digests = {}
+        for e in self.entries:
+            filename = urllib.parse.unquote(e['url'].split('/')[-1])
+            digests[filename] = hashlib.sha1(self.files[e['url']]).hexdigest()
+        return digests
+
+##############################################################################
+# fault configuration                                                        #
+##############################################################################
+
+class FaultConfig:
+    # all rates are probabilities per request, bandwidth is in bytes/s
+    keys = ['latency', 'bandwidth', 'truncateRate', 'disconnectRate', 'wrongLengthRate', 'errorRate', 'burstLength', 'errorStatus', 'faultyList']
+
+    def __init__(self, **kwargs):
+        self.latency = 0.0
+        self.bandwidth = 0
+        self.truncateRate = 0.0
+        self.disconnectRate = 0.0
+        self.wrongLengthRate = 0.0
+        self.errorRate = 0.0
+        self.burstLength = 3
+        self.errorStatus = [503, 429, 500]
+        self.faultyList = False
+        for name, value in kwargs.items():
+            if name not in self.keys:
+                raise ValueError('unknown fault setting "' + name + '"')
+            setattr(self, name, value)
+
+    def asDict(self):
+        return {k: getattr(self, k) for k in self.keys}
+
+scenarios = {
+    'clean': FaultConfig(),
+    'slow': FaultConfig(latency=0.2, bandwidth=256*1024),
+    'flaky': FaultConfig(truncateRate=0.1, disconnectRate=0.1, wrongLengthRate=0.05),
+    'overloaded': FaultConfig(latency=0.05, errorRate=0.1, burstLength=5, faultyList=True),
+    'chaos': FaultConfig(latency=0.05, bandwidth=1024*1024, truncateRate=0.1, disconnectRate=0.1, wrongLengthRate=0.05, errorRate=0.05, faultyList=True)
+}
+
+##############################################################################
+# the simulated map server                                                   #
+##############################################################################
+
+class SimServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalogue, faults, seed, port=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), SimRequestHandler)
+        self.catalogue = catalogue
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.burstLeft = 0
+        self.stats = {}
+        self.thread = None
+
+    def getURL(self):
+        return 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def randint(self, a, b):
+        with self.lock:
+            return self.rng.randint(a, b)
+
+    def nextError(self, isList):
+        # returns the status code of an injected error, or None
+        if isList and not self.faults.faultyList:
+            return None
+        with self.lock:
+            if self.burstLeft <= 0 and self.faults.errorRate > 0 and self.rng.random() < self.faults.errorRate:
+                self.burstLeft = self.faults.burstLength
+            if self.burstLeft > 0:
+                self.burstLeft = self.burstLeft - 1
+                return self.rng.choice(self.faults.errorStatus)
+        return None
+
+    def handle_error(self, request, client_address):
+        # the client gave up on the connection, e.g. after an injected fault
+        self.count('client aborts')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class SimRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        faults = server.faults
+        server.count('requests')
+        if faults.latency > 0:
+            time.sleep(faults.latency)
+        path = urllib.parse.urlsplit(self.path).path
+        isList = (path == olmap.Config.settings['mapServerListURL'])
+        if isList:
+            data = server.catalogue.listData
+        else:
+            data = server.catalogue.files.get(path)
+            if data == None:
+                data = server.catalogue.files.get(urllib.parse.quote(urllib.parse.unquote(path)))
+        if data == None:
+            self.sendError(404)
+            return
+        status = server.nextError(isList)
+        if status != None:
+            server.count('error ' + str(status))
+            self.sendError(status)
+            return
+        start = 0
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader != None and rangeHeader.startswith('bytes=') and rangeHeader.endswith('-'):
+            start = int(rangeHeader[6:-1])
+            if start >= len(data):
+                server.count('range not satisfiable')
+                self.sendError(416)
+                return
+            server.count('resumed')
+        body = data[start:]
+        length = len(body)
+        faulty = isList == False or faults.faultyList
+        if faulty and server.chance(faults.wrongLengthRate):
+            server.count('wrong length')
+            length = max(length + (1 if server.chance(0.5) else -1) * max(length // 4, 1), 0)
+        cut = None
+        abort = False
+        if faulty and server.chance(faults.truncateRate):
+            server.count('truncated')
+            cut = server.randint(0, len(body))
+        elif faulty and server.chance(faults.disconnectRate):
+            server.count('disconnected')
+            cut = server.randint(0, len(body))
+            abort = True
+        self.send_response(206 if start > 0 else 200)
+        self.send_header('Content-Type', 'application/json' if isList else 'application/zip')
+        self.send_header('Content-Length', str(length))
+        if start > 0:
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(len(data) - 1) + '/' + str(len(data)))
+        if cut != None or length != len(body):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        sent = self.sendBody(body[:min(length, len(body))] if cut == None else body[:cut])
+        server.count('bytes sent', sent)
+        if abort:
+            # reset the connection instead of closing it cleanly
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+
+    def sendBody(self, body):
+        bandwidth = self.server.faults.bandwidth
+        chunk = 16 * 1024
+        sent = 0
+        try:
+            while sent < len(body):
+                part = body[sent:sent+chunk]
+                self.wfile.write(part)
+                sent = sent + len(part)
+                if bandwidth > 0:
+                    time.sleep(len(part) / bandwidth)
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        return sent
+
+    def sendError(self, status):
+        body = ('{"error": ' + str(status) + '}').encode('utf-8')
+        self.send_response(status)
+        if status == 429 or status == 503:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+##############################################################################
+# scenario runner                                                            #
+##############################################################################
+
+class ScenarioRunner:
+    def __init__(self, args):
+        self.args = args
+
+    def configure(self, server, workDir):
+        mapPath = workDir + '/maps/'
+        os.makedirs(mapPath, exist_ok=True)
+        argv = ['-s', 'configFile', workDir + '/olmappy.json',
+                '-s', 'mapPath', mapPath,
+                '-s', 'mapServer', server.getURL(),
+                '-s', 'logLevel', str(self.args.log_level),
+                '-s', 'maxConnections', str(self.args.connections)]
+        for name, value in self.args.set or []:
+            argv = argv + ['-s', name, value]
+        olmap.Cmd.parse(argv + ['UPDATE'])
+        return mapPath
+
+    def checkMaps(self, catalogue, mapPath):
+        # count the maps which are present and identical to the server's
+        digests = catalogue.getDigests()
+        cntOk = 0
+        cntBad = 0
+        for filename, digest in digests.items():
+            try:
+                f = open(mapPath + filename, 'rb')
+                ok = hashlib.sha1(f.read()).hexdigest() == digest
+                f.close()
+            except FileNotFoundError:
+                continue
+            if ok:
+                cntOk = cntOk + 1
+            else:
+                cntBad = cntBad + 1
+        return cntOk, cntBad
+
+    def run(self, name, faults):
+        catalogue = SimCatalogue(self.args.maps, self.args.min_size, self.args.max_size, self.args.seed)
+        totalBytes = sum(e['size'] for e in catalogue.entries)
+        server = SimServer(catalogue, faults, self.args.seed)
+        server.start()
+        workDir = tempfile.mkdtemp(prefix='olmapsim-')
+        rounds = []
+        try:
+            mapPath = self.configure(server, workDir)
+            start = time.perf_counter()
+            for r in range(self.args.rounds):
+                roundStart = time.perf_counter()
+                local = olmap.localMapManager()
+                remote = olmap.remoteMapManager()
+                local.update()
+                listOk = remote.update()
+                if listOk:
+                    local.updateFromRemote(remote)
+                    local.saveMapList()
+                cntOk, cntBad = self.checkMaps(catalogue, mapPath)
+                rounds.append({'round': r + 1, 'seconds': time.perf_counter() - roundStart, 'list': listOk, 'complete': cntOk, 'mismatched': cntBad})
+                if cntOk == len(catalogue.entries):
+                    break
+            elapsed = time.perf_counter() - start
+        finally:
+            server.stop()
+            if not self.args.keep:
+                shutil.rmtree(workDir, ignore_errors=True)
+        last = rounds[-1]
+        return {
+            'scenario': name,
+            'faults': faults.asDict(),
+            'maps': len(catalogue.entries),
+            'bytes': totalBytes,
+            'seconds': elapsed,
+            'throughput': totalBytes / elapsed if elapsed > 0 else 0,
+            'converged': last['complete'] == len(catalogue.entries),
+            'rounds': rounds,
+            'server': server.stats,
+            'workDir': workDir if self.args.keep else None
+        }
+
+    @staticmethod
+    def show(result):
+        state = 'converged after ' + str(len(result['rounds'])) + ' rounds' if result['converged'] else 'NOT converged after ' + str(len(result['rounds'])) + ' rounds'
+        print(result['scenario'] + ': ' + str(result['maps']) + ' maps, ' + str(result['bytes']) + ' bytes, ' + state + ', ' + '%.2f s, %.1f KiB/s' % (result['seconds'], result['throughput'] / 1024))
+        for r in result['rounds']:
+            print('    round %d: %.2f s, list %s, %d complete, %d mismatched' % (r['round'], r['seconds'], 'ok' if r['list'] else 'FAILED', r['complete'], r['mismatched']))
+        print('    server: ' + ', '.join(k + ' ' + str(v) for k, v in sorted(result['server'].items())))
+
+##############################################################################
+# main program entry point                                                   #
+##############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Run olmappy against a simulated map server with injected faults.')
+    parser.add_argument('scenario', nargs='*', help='the scenarios to run, must be one of: ' + ', '.join(scenarios) + '. Default is all of them.')
+    parser.add_argument('--maps', type=int, default=50, help='number of maps in the generated catalogue')
+    parser.add_argument('--min-size', type=int, default=16*1024, help='minimum map size in bytes')
+    parser.add_argument('--max-size', type=int, default=256*1024, help='maximum map size in bytes')
+    parser.add_argument('--rounds', type=int, default=10, help='maximum number of UPDATE runs per scenario')
+    parser.add_argument('--connections', type=int, default=4, help='value for the maxConnections setting')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the catalogue and the faults')
+    parser.add_argument('--fault', action='append', nargs=2, metavar=('NAME', 'VALUE'), help='override a fault setting of the scenarios: ' + ', '.join(FaultConfig.keys))
+    parser.add_argument('-s', '--set', action='append', nargs=2, metavar=('NAME', 'VALUE'), help='set olmappy configuration option NAME to VALUE')
+    parser.add_argument('--log-level', type=int, default=olmap.LogLevel.ERROR, help='olmappy log level')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON to FILE')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch map directories')
+    parser.add_argument('--serve', action='store_true', help='only run the server of the first scenario until interrupted')
+    parser.add_argument('--port', type=int, default=8765, help='port for --serve')
+    args = parser.parse_args()
+    if args.rounds < 1:
+        parser.error('--rounds must be at least 1')
+
+    names = args.scenario if len(args.scenario) > 0 else list(scenarios)
+    for n in names:
+        if n not in scenarios:
+            parser.error('unknown scenario "' + n + '"')
+    for name, value in args.fault or []:
+        if name not in FaultConfig.keys:
+            parser.error('unknown fault setting "' + name + '"')
+        for faults in scenarios.values():
+            default = getattr(faults, name)
+            if type(default) is list:
+                setattr(faults, name, [int(v) for v in value.split(',')])
+            elif type(default) is bool:
+                setattr(faults, name, olmap.stringAsBool(value))
+            else:
+                setattr(faults, name, type(default)(value))
+
+    if args.serve:
+        catalogue = SimCatalogue(args.maps, args.min_size, args.max_size, args.seed)
+        server = SimServer(catalogue, scenarios[names[0]], args.seed, args.port)
+        print('serving ' + str(args.maps) + ' maps with scenario ' + names[0] + ' at ' + server.getURL())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        return 0
+
+    runner = ScenarioRunner(args)
+    results = []
+    for n in names:
+        result = runner.run(n, scenarios[n])
+        runner.show(result)
+        results.append(result)
+    if args.json != None:
+        f = open(file = args.json, mode = 'wt', encoding = 'utf-8')
+        json.dump(results, f, indent=4)
+        f.close()
+    return 0 if all(r['converged'] for r in results) else 1
+
+if __name__ == '__main__':
+    exit(main())
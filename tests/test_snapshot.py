@@ -0,0 +1,75 @@
+# a validated map list must survive the catalogue snapshot unchanged, and
+# records the snapshot can't store must not break the validation
+
+import copy
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import olmap
+
+def makeMap(mapId, filename, **fields):
+    m = {'url': '/' + mapId + '/' + filename, 'mtime': 1600000000, 'size': 1234, 'levels': [{'type': 'mp', 'name': 'Level ' + mapId}]}
+    m.update(fields)
+    return m
+
+@pytest.fixture
+def setup(tmp_path):
+    def configure(caseSensitive = False):
+        olmap.Cmd.parse(['-s', 'configFile', str(tmp_path / 'olmappy.json'),
+                         '-s', 'mapPath', str(tmp_path) + '/',
+                         '-s', 'logLevel', str(olmap.LogLevel.ERROR),
+                         '-s', 'catalogueSnapshots', 'true',
+                         '-s', 'remoteHistory', 'false',
+                         '-s', 'filenameCaseSensitive', str(caseSensitive),
+                         'LISTREMOTE'])
+    return configure
+
+def validate(maps, fingerprint = 'list:test'):
+    manager = olmap.remoteMapManager()
+    manager.timestamp = 99
+    assert not manager.loadSnapshot(fingerprint)
+    manager.maps = copy.deepcopy(maps)
+    manager.valid = True
+    assert manager.validateMapList()
+    return manager.maps
+
+def reload(fingerprint = 'list:test'):
+    manager = olmap.remoteMapManager()
+    if not manager.loadSnapshot(fingerprint):
+        return None
+    return manager.maps
+
+def test_snapshot_round_trip(setup):
+    setup()
+    maps = [makeMap('id1', 'a.zip'), makeMap('id2', 'b.zip', mtime = 1600000000.5, extra = {'x': [1, 2]}),
+            makeMap('id3', 'c.zip', levels = [{'type': 'sp', 'name': 'A', 'author': 'me'}])]
+    validated = validate(maps)
+    assert json.dumps(reload()) == json.dumps(validated)
+
+@pytest.mark.parametrize('fields', [
+    {'size': 1234.0},
+    {'size': 2**63},
+    {'mtime': '1600000000'},
+    {'mtime': 2**60 + 1},
+    {'hidden': True},
+    {'hidden': 'no'},
+    {'levels': [{'type': 'mp', 'name': 5}]}
+])
+def test_unstorable_records_skip_the_snapshot(setup, fields):
+    setup()
+    maps = [makeMap('id1', 'a.zip'), makeMap('id2', 'b.zip', **fields)]
+    validated = validate(maps)
+    assert len(validated) == 2
+    assert reload() == None
+
+def test_snapshot_depends_on_filename_case(setup):
+    setup(False)
+    maps = [makeMap('id1', 'a.zip'), makeMap('id2', 'A.zip', mtime = 1600000001)]
+    assert len(validate(maps)) == 2
+    setup(True)
+    assert reload() == None
+    assert len(validate(maps)) == 1
@@ -0,0 +1,97 @@
+# validateMapBatch must accept the same maps as validating the entries one by
+# one with validateMap and resolving duplicate file names in list order
+
+import copy
+import json
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import olmap
+
+def makeEntry(rng):
+    filename = rng.choice(['a.zip', 'b.zip', 'B.zip', 'c%20d.zip', '%41.zip', 'x', '', '%'])
+    m = {
+        'url': '/' + rng.choice(['id1', 'id2', '', 'id3']) + '/' + filename,
+        'mtime': rng.choice([1, 2, 3, 3]),
+        'size': rng.choice([10, 0, 5, 7.0]),
+        'levels': [{'type': rng.choice(['mp', 'cm', 'sp', 'MP', 'zz']), 'name': rng.choice(['A', 'B'])} for i in range(rng.randint(0, 3))]
+    }
+    r = rng.random()
+    if r < 0.05:
+        del m['url']
+    elif r < 0.1:
+        m['url'] = 'abcdefg'
+    elif r < 0.13:
+        m['url'] = '/ab'
+    elif r < 0.16:
+        del m['mtime']
+    elif r < 0.19:
+        del m['size']
+    elif r < 0.22:
+        del m['levels']
+    elif r < 0.24:
+        m['levels'] = [{'name': 'x'}]
+    elif r < 0.26:
+        m['levels'] = [{'type': 'mp'}]
+    elif r < 0.27:
+        m = 'url'
+    elif r < 0.28:
+        m['size'] = None
+    elif r < 0.29:
+        m['levels'] = ['typename']
+    elif r < 0.30:
+        m['hidden'] = 1
+    return m
+
+def validateOneByOne(manager, maps):
+    # the per-entry validation the batch replaced
+    manager.maps = []
+    for m in maps:
+        if not manager.validateMap(m):
+            continue
+        myMap = manager.findMapByFileName(m['filename'])
+        if myMap == None:
+            manager.maps = manager.maps + [m]
+        elif myMap['mtime'] < m['mtime']:
+            manager.maps.remove(myMap)
+            manager.maps = manager.maps + [m]
+    return manager.maps
+
+@pytest.fixture
+def manager(tmp_path):
+    olmap.Cmd.parse(['-s', 'configFile', str(tmp_path / 'olmappy.json'),
+                     '-s', 'mapPath', str(tmp_path) + '/',
+                     '-s', 'logLevel', str(olmap.LogLevel.ERROR),
+                     '-s', 'catalogueSnapshots', 'false',
+                     '-s', 'remoteHistory', 'false',
+                     'LISTREMOTE'])
+    manager = olmap.remoteMapManager()
+    manager.timestamp = 99
+    return manager
+
+@pytest.mark.parametrize('caseSensitive', [False, True])
+def test_batch_matches_per_entry_validation(manager, caseSensitive):
+    olmap.Config.settings['filenameCaseSensitive'] = caseSensitive
+    for seed in range(500):
+        rng = random.Random(seed)
+        maps = [makeEntry(rng) for i in range(rng.randint(0, 30))]
+        expected = validateOneByOne(manager, copy.deepcopy(maps))
+        accepted, rejects = manager.validateMapBatch(copy.deepcopy(maps))
+        # the same maps with the same fields in the same order
+        assert json.dumps(accepted) == json.dumps(expected), 'seed ' + str(seed)
+        cntRejected = sum(len(refs) for refs in rejects.values())
+        assert cntRejected == len([m for m in copy.deepcopy(maps) if not manager.validateMap(m)]), 'seed ' + str(seed)
+
+def test_newer_duplicate_replaces_older(manager):
+    maps = [
+        {'url': '/id1/a.zip', 'mtime': 1, 'size': 10, 'levels': [{'type': 'mp', 'name': 'A'}]},
+        {'url': '/id2/b.zip', 'mtime': 1, 'size': 10, 'levels': [{'type': 'mp', 'name': 'B'}]},
+        {'url': '/id3/a.zip', 'mtime': 2, 'size': 10, 'levels': [{'type': 'mp', 'name': 'A'}]},
+        {'url': '/id4/b.zip', 'mtime': 0, 'size': 10, 'levels': [{'type': 'mp', 'name': 'B'}]}
+    ]
+    accepted, rejects = manager.validateMapBatch(maps)
+    assert [m['id'] for m in accepted] == ['id2', 'id3']